@@ -1,17 +1,24 @@
+from collections import deque
 import datetime
 import decimal
+from itertools import islice
 import logging
 import os
 import shutil
 
+from django.conf import settings
 from django.db.utils import DatabaseError
+from django.utils.functional import Promise
+from django.utils.safestring import EscapeString, EscapeUnicode, \
+    SafeString, SafeUnicode
 
-from google.appengine.api.datastore import Delete, Query
+from google.appengine.api.datastore import Delete, DeleteAsync, Query
 from google.appengine.api.datastore_errors import BadArgumentError, \
     BadValueError
 from google.appengine.api.datastore_types import Blob, Key, Text, \
     ValidateInteger
-from google.appengine.api.namespace_manager import set_namespace
+from google.appengine.api.namespace_manager import get_namespace, \
+    set_namespace
 from google.appengine.ext.db.metadata import get_kinds, get_namespaces
 
 from djangotoolbox.db.base import (
@@ -26,6 +33,8 @@ from djangotoolbox.db.utils import decimal_to_string
 from ..boot import DATA_ROOT
 from ..utils import appid, on_production_server
 from .creation import DatabaseCreation
+from .db_settings import setting_changed
+from .signals import query_executed
 from .stubs import stub_manager
 
 
@@ -36,6 +45,12 @@ DATASTORE_PATHS = {
     'prospective_search_path': os.path.join(DATA_ROOT, 'prospective-search'),
 }
 
+# Batch size of delete_all_entities' scans and Deletes, and the
+# number of kinds scanned and of Deletes sent concurrently.
+FLUSH_BATCH_SIZE = 500
+MAX_FLUSH_SCANS = 10
+MAX_FLUSH_RPCS = 10
+
 
 def key_from_path(db_table, value):
     """
@@ -49,6 +64,59 @@ def key_from_path(db_table, value):
     return Key.from_path(db_table, value)
 
 
+# Field kinds whose values are converted by djangotoolbox, for which
+# DatabaseOperations.get_converter() doesn't build specialized
+# converters.
+GENERIC_CONVERSION_KINDS = ('ListField', 'SetField', 'DictField',
+                            'EmbeddedModelField', 'DecimalField')
+
+
+def _key_from_db(value):
+    assert isinstance(value, Key), \
+        "GAE db.Key expected! Try changing to old storage, " \
+        "dumping data, changing to new storage and reloading."
+    assert value.parent() is None, "Parents are not yet supported!"
+    return value.id_or_name()
+
+
+def _string_from_db(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def _string_for_db(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def _text_for_db(value):
+    return Text(_string_for_db(value))
+
+
+# Specialized single value conversions by db_type, for values other
+# than None; see DatabaseOperations._value_for_db and _value_from_db.
+FROM_DB_CONVERTERS = {
+    'key': _key_from_db,
+    'string': _string_from_db,
+    'text': _string_from_db,
+    'date': lambda value: value.date(),
+    'time': lambda value: value.time(),
+    'bytes': str,
+}
+
+FOR_DB_CONVERTERS = {
+    'string': _string_for_db,
+    'text': _text_for_db,
+    'date': lambda value: datetime.datetime.combine(
+        value, DatabaseOperations.DEFAULT_TIME),
+    'time': lambda value: datetime.datetime.combine(
+        DatabaseOperations.DEFAULT_DATE, value),
+    'bytes': Blob,
+}
+
+
 def get_datastore_paths(options):
     paths = {}
     for key, path in DATASTORE_PATHS.items():
@@ -100,6 +168,86 @@ class DatabaseOperations(NonrelDatabaseOperations):
     # Time used to store dates as datetimes.
     DEFAULT_TIME = datetime.time()
 
+    def __init__(self, *args, **kwargs):
+        super(DatabaseOperations, self).__init__(*args, **kwargs)
+
+        # (field, converter) pairs by (id(field), direction, lookup);
+        # the field is kept so that its id can't be reused.
+        self._converters = {}
+
+        # Conversions depend on indexes set in GAE_SETTINGS_MODULES.
+        setting_changed.connect(self.clear_converters)
+
+    def clear_converters(self, **kwargs):
+        self._converters.clear()
+
+    def get_converter(self, field, direction, lookup=None):
+        """
+        Returns a callable converting a single value of the field like
+        _value_for_db (direction "for_db") or _value_from_db ("from_db")
+        would, specialized for the field's kind and db_type; cached per
+        field, direction and lookup.
+        """
+        key = (id(field), direction, lookup)
+        try:
+            return self._converters[key][1]
+        except KeyError:
+            pass
+
+        if direction == 'for_db':
+            converter = self._make_for_db_converter(
+                *self._convert_as(field, lookup) + (lookup,))
+        else:
+            converter = self._make_from_db_converter(
+                *self._convert_as(field))
+        self._converters[key] = (field, converter)
+        return converter
+
+    def _make_for_db_converter(self, field, field_kind, db_type, lookup):
+        if field_kind in GENERIC_CONVERSION_KINDS:
+            return lambda value: self._value_for_db(
+                value, field, field_kind, db_type, lookup)
+
+        if db_type == 'key':
+            db_table = field.model._meta.db_table
+
+            def convert(value):
+                try:
+                    return key_from_path(db_table, value)
+                except (BadArgumentError, BadValueError,):
+                    raise DatabaseError("Only strings and positive "
+                                        "integers may be used as keys on "
+                                        "GAE. Received %r." % value)
+        else:
+            convert = FOR_DB_CONVERTERS.get(db_type)
+
+        def converter(value):
+            if value is None:
+                return None
+
+            # Same as djangotoolbox does for other field kinds.
+            if isinstance(value, Promise):
+                value = unicode(value)
+            if isinstance(value, (SafeString, EscapeString)):
+                value = str(value)
+            elif isinstance(value, (SafeUnicode, EscapeUnicode)):
+                value = unicode(value)
+
+            if convert is not None:
+                value = convert(value)
+            return value
+        return converter
+
+    def _make_from_db_converter(self, field, field_kind, db_type):
+        if field_kind in GENERIC_CONVERSION_KINDS:
+            return lambda value: self._value_from_db(
+                value, field, field_kind, db_type)
+
+        convert = FROM_DB_CONVERTERS.get(db_type)
+        if convert is None:
+            return lambda value: value
+        return lambda value: None if value is None else convert(value)
+
     def sql_flush(self, style, tables, sequences, allow_cascade=False):
         self.connection.flush()
         return []
@@ -114,6 +262,8 @@ class DatabaseOperations(NonrelDatabaseOperations):
 
     def value_for_db(self, value, field, lookup=None):
         """
+        Converts values with the cached converters of get_converter().
+
         We'll simulate `startswith` lookups with two inequalities:
 
             property >= value and property <= value + u'\ufffd',
@@ -121,11 +271,19 @@ class DatabaseOperations(NonrelDatabaseOperations):
         and need to "double" the value before passing it through the
         actual datastore conversions.
         """
-        super_value_for_db = super(DatabaseOperations, self).value_for_db
+        # Argument to the "isnull" lookup is just a boolean, while some
+        # other lookups take a list of values.
+        if lookup == 'isnull':
+            return value
+        convert = self.get_converter(field, 'for_db', lookup)
         if lookup == 'startswith':
-            return [super_value_for_db(value, field, lookup),
-                    super_value_for_db(value + u'\ufffd', field, lookup)]
-        return super_value_for_db(value, field, lookup)
+            return [convert(value), convert(value + u'\ufffd')]
+        elif lookup in ('in', 'range', 'year'):
+            return [convert(subvalue) for subvalue in value]
+        return convert(value)
+
+    def value_from_db(self, value, field):
+        return self.get_converter(field, 'from_db')(value)
 
     def _value_for_db(self, value, field, field_kind, db_type, lookup):
         """
@@ -306,10 +464,14 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         else:
             stub_manager.setup_stubs(self)
 
+        if getattr(settings, 'DATASTORE_QUERY_STATS', False):
+            from .querystats import record_query
+            query_executed.connect(record_query)
+
     def flush(self):
         """
         Helper function to remove the current datastore and re-open the
-        stubs.
+        stubs (test stubs are just emptied).
         """
         if stub_manager.active_stubs == 'remote':
             import random
@@ -329,7 +491,7 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             response = raw_input("Repeat: ")
             if code == response:
                 print "Deleting..."
-                delete_all_entities()
+                delete_all_entities(progress=print_flush_progress)
                 print "Datastore flushed! Please check your dashboard's " \
                       "datastore viewer for any remaining entities and " \
                       "remove all unneeded indexes with appcfg.py " \
@@ -338,21 +500,69 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
                 print "Aborting."
                 exit()
         elif stub_manager.active_stubs == 'test':
-            stub_manager.deactivate_test_stubs()
-            stub_manager.activate_test_stubs(self)
+            stub_manager.clear_test_stubs()
         else:
             destroy_datastore(get_datastore_paths(self.settings_dict))
             stub_manager.reset_stubs(self)
 
 
-def delete_all_entities():
-    for namespace in get_namespaces():
-        set_namespace(namespace)
-        for kind in get_kinds():
-            if kind.startswith('__'):
-                continue
-            while True:
-                data = Query(kind=kind, keys_only=True).Get(200)
-                if not data:
-                    break
-                Delete(data)
+def delete_all_entities(batch_size=FLUSH_BATCH_SIZE, queue=None,
+                        progress=None):
+    """
+    Deletes the entities of all kinds in all namespaces.
+
+    Up to MAX_FLUSH_SCANS kinds are scanned concurrently with keys-only
+    queries, and each batch of keys is deleted with an async Delete
+    (up to MAX_FLUSH_RPCS in flight) while the scans go on, or deferred
+    to the given task queue. progress is called with the namespace,
+    kind and number of entities deleted so far after each batch.
+    """
+    kinds = deque()
+    original_namespace = get_namespace()
+    try:
+        for namespace in get_namespaces():
+            set_namespace(namespace)
+            kinds.extend((namespace, kind) for kind in get_kinds()
+                         if not kind.startswith('__'))
+    finally:
+        set_namespace(original_namespace)
+
+    scans = deque()
+    rpcs = deque()
+    while kinds or scans:
+        while kinds and len(scans) < MAX_FLUSH_SCANS:
+            namespace, kind = kinds.popleft()
+            keys = Query(kind=kind, namespace=namespace,
+                         keys_only=True).Run(batch_size=batch_size)
+            scans.append((namespace, kind, keys, [0]))
+
+        namespace, kind, keys, deleted = scans.popleft()
+        batch = list(islice(keys, batch_size))
+        if batch:
+            if queue is not None:
+                from google.appengine.ext import deferred
+                deferred.defer(delete_keys, batch, _queue=queue)
+            else:
+                if len(rpcs) >= MAX_FLUSH_RPCS:
+                    rpcs.popleft().get_result()
+                rpcs.append(DeleteAsync(batch))
+            deleted[0] += len(batch)
+            if progress is not None:
+                progress(namespace, kind, deleted[0])
+        if len(batch) == batch_size:
+            scans.append((namespace, kind, keys, deleted))
+    while rpcs:
+        rpcs.popleft().get_result()
+
+
+def delete_keys(keys):
+    """
+    Deletes a batch of keys, run by the task queue for
+    delete_all_entities.
+    """
+    Delete(keys)
+
+
+def print_flush_progress(namespace, kind, deleted):
+    print "%s%s: %d deleted" % (namespace and namespace + '/', kind,
+                                deleted)
@@ -0,0 +1,256 @@
+"""
+Memcache-backed caching of datastore entities and query results.
+
+Models opt in through the ENTITY_CACHE and QUERY_CACHE dicts of
+GAE_SETTINGS_MODULES (see db_settings). Cached entities are stored as
+encoded protocol buffers under their string-encoded keys and dropped
+whenever the compilers write or delete them. Cached query results are
+keyed on the query and a per-kind generation, which every write to the
+kind changes. Counts can be cached for a while too, without being
+invalidated by writes.
+"""
+
+from hashlib import md5
+import time
+from uuid import uuid4
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Entity, GetAsync, \
+    IsInTransaction
+from google.appengine.api.datastore_types import Key
+from google.appengine.datastore.datastore_query import Cursor
+
+from .db_settings import get_model_entity_cache, get_model_query_cache
+
+
+ENTITY_KEY_PREFIX = 'djangoappengine:entity:'
+QUERY_KEY_PREFIX = 'djangoappengine:query:'
+GENERATION_KEY_PREFIX = 'djangoappengine:generation:'
+COUNT_KEY_PREFIX = 'djangoappengine:count:'
+
+# Maximum number of entities held by the in-process entity cache.
+LOCAL_CACHE_SIZE = 1000
+
+# Value of memcache entries locked against filling with entities read
+# before a write, and how many seconds the locks last.
+LOCKED = 0
+LOCK_TIMEOUT = 32
+
+# Encoded entities kept in process memory, by string-encoded key, with
+# their expiration times.
+_local_entities = {}
+
+
+def get_entities_async(model, keys, **config):
+    """
+    Starts a batch Get for the keys and returns a callable that waits
+    for it, returning a list of entities (None for missing ones) in the
+    order of the keys.
+
+    For models using the entity cache only the keys missing from the
+    cache get fetched from the datastore, and are then cached. Entities
+    are looked up in process memory first if the model's options have a
+    "local_timeout", then in memcache. Transactions always read from
+    the datastore.
+
+    Writes replace cached entities with locks (see invalidate_cache),
+    so missing entries are locked before the Get is sent and filled
+    with compare-and-set: if the entity gets written meanwhile, the
+    fill fails instead of caching the old entity.
+    """
+    options = get_model_entity_cache(model)
+    if options is None or IsInTransaction():
+        return GetAsync(keys, **config).get_result
+
+    local_timeout = options.get('local_timeout', 0)
+    cache_keys = [str(key) for key in keys]
+    cached = {}
+    if local_timeout:
+        now = time.time()
+        for cache_key in cache_keys:
+            item = _local_entities.get(cache_key)
+            if item is not None and item[0] > now:
+                cached[cache_key] = item[1]
+    client = memcache.Client()
+    from_memcache = dict(
+        (cache_key, value) for cache_key, value in client.get_multi(
+            [cache_key for cache_key in cache_keys
+             if cache_key not in cached],
+            key_prefix=ENTITY_KEY_PREFIX).iteritems()
+        if value != LOCKED)
+    cached.update(from_memcache)
+    missing = [key for key, cache_key in zip(keys, cache_keys)
+               if cache_key not in cached]
+    if missing:
+        missing_keys = [str(key) for key in missing]
+        client.add_multi(dict((cache_key, LOCKED)
+                              for cache_key in missing_keys),
+                         time=LOCK_TIMEOUT, key_prefix=ENTITY_KEY_PREFIX)
+        locked = client.get_multi(missing_keys, key_prefix=ENTITY_KEY_PREFIX,
+                                  for_cas=True)
+        rpc = GetAsync(missing, **config)
+
+    def get_results():
+        fetched = {}
+        if missing:
+            for key, entity in zip(missing, rpc.get_result()):
+                if entity is not None:
+                    fetched[str(key)] = entity.ToPb().Encode()
+        fills = dict((cache_key, encoded)
+                     for cache_key, encoded in fetched.iteritems()
+                     if locked.get(cache_key) == LOCKED)
+        if fills:
+            for cache_key in client.cas_multi(
+                    fills, time=options.get('timeout', 0),
+                    key_prefix=ENTITY_KEY_PREFIX):
+                del fills[cache_key]
+        if local_timeout:
+            _cache_locally(from_memcache, local_timeout)
+            _cache_locally(fills, local_timeout)
+
+        results = []
+        for cache_key in cache_keys:
+            encoded = cached.get(cache_key) or fetched.get(cache_key)
+            if encoded is None:
+                results.append(None)
+            else:
+                results.append(Entity.FromPb(encoded))
+        return results
+    return get_results
+
+
+def _cache_locally(encoded_entities, timeout):
+    if len(_local_entities) + len(encoded_entities) > LOCAL_CACHE_SIZE:
+        _local_entities.clear()
+    expires = time.time() + timeout
+    for cache_key, encoded in encoded_entities.iteritems():
+        _local_entities[cache_key] = (expires, encoded)
+
+
+def clear_local_cache():
+    """
+    Drops all entities cached in process memory.
+    """
+    _local_entities.clear()
+
+
+def invalidate_cache(model, keys):
+    """
+    Removes the entities with the given keys from the entity cache and
+    invalidates cached query results for their kind; should be called
+    after entities are changed or deleted.
+
+    Cached entities are replaced with short-lived locks rather than
+    deleted, so reads that started before the write can't fill the
+    cache with the old entities afterwards. Inside a transaction the
+    old entities can still be read until the commit, so the entries
+    are deleted and locked against any fill for LOCK_TIMEOUT seconds
+    instead.
+    """
+    if not keys:
+        return
+    if get_model_entity_cache(model) is not None:
+        cache_keys = [str(key) for key in keys]
+        if IsInTransaction():
+            memcache.delete_multi(cache_keys, seconds=LOCK_TIMEOUT,
+                                  key_prefix=ENTITY_KEY_PREFIX)
+        else:
+            memcache.set_multi(dict((cache_key, LOCKED)
+                                    for cache_key in cache_keys),
+                               time=LOCK_TIMEOUT,
+                               key_prefix=ENTITY_KEY_PREFIX)
+        for cache_key in cache_keys:
+            _local_entities.pop(cache_key, None)
+    if get_model_query_cache(model) is not None:
+        memcache.set(GENERATION_KEY_PREFIX + model._meta.db_table,
+                     uuid4().hex)
+
+
+def get_generation(kind):
+    """
+    Returns the current generation of the kind; a random token so that
+    an evicted generation doesn't bring back old results.
+    """
+    key = GENERATION_KEY_PREFIX + kind
+    generation = memcache.get(key)
+    if generation is None:
+        generation = uuid4().hex
+        if not memcache.add(key, generation):
+            generation = memcache.get(key) or generation
+    return generation
+
+
+class CachedQuery(object):
+    """
+    Memcache entry holding the results of a query, either their keys
+    or (with the "entities" option) whole entities, together with the
+    cursor at the end of the results.
+    """
+
+    def __init__(self, model, options, keys_only, *key_parts):
+        kind = model._meta.db_table
+        self.timeout = options.get('timeout', 0)
+        self.store_entities = options.get('entities', False) and \
+            not keys_only
+        key = repr((kind, get_generation(kind), self.store_entities) +
+                   key_parts)
+        self.key = QUERY_KEY_PREFIX + md5(key).hexdigest()
+
+    def get(self):
+        """
+        Returns a (results, cursor) pair, or None if the results aren't
+        cached. Results are keys unless whole entities are stored.
+        """
+        value = memcache.get(self.key)
+        if value is None:
+            return None
+        results, cursor = value
+        if self.store_entities:
+            results = [Entity.FromPb(result) for result in results]
+        else:
+            results = [Key(result) for result in results]
+        if cursor is not None:
+            cursor = Cursor.from_websafe_string(cursor)
+        return results, cursor
+
+    def collect(self, results, get_cursor=None):
+        """
+        Passes the results through, caching them once all were read.
+        """
+        collected = []
+        for result in results:
+            collected.append(result)
+            yield result
+
+        if self.store_entities:
+            value = [result.ToPb().Encode() for result in collected]
+        else:
+            value = [str(result if isinstance(result, Key) else
+                         result.key())
+                     for result in collected]
+        cursor = get_cursor() if get_cursor is not None else None
+        if cursor is not None:
+            cursor = Cursor.to_websafe_string(cursor)
+        try:
+            memcache.set(self.key, (value, cursor), time=self.timeout)
+        except ValueError:
+            # Too large for memcache.
+            pass
+
+
+class CachedCount(object):
+    """
+    Memcache entry holding the approximate number of results of a
+    query; it's only dropped when it expires.
+    """
+
+    def __init__(self, model, timeout, *key_parts):
+        self.timeout = timeout
+        key = repr((model._meta.db_table,) + key_parts)
+        self.key = COUNT_KEY_PREFIX + md5(key).hexdigest()
+
+    def get(self):
+        return memcache.get(self.key)
+
+    def set(self, count):
+        memcache.set(self.key, count, time=self.timeout)
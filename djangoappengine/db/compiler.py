@@ -1,4 +1,8 @@
+from collections import deque
+import datetime
 from functools import wraps
+import heapq
+from itertools import chain, islice
 import sys
 
 from django.db.models.fields import AutoField
@@ -8,13 +12,16 @@ from django.db.models.sql.where import AND, OR
 from django.db.utils import DatabaseError, IntegrityError
 from django.utils.tree import Node
 
-from google.appengine.api.datastore import Entity, Query, MultiQuery, \
-    Put, Get, Delete
+from google.appengine.api.datastore import Entity, Query, Put, Get, \
+    Delete, DeleteAsync, IsInTransaction, PutAsync
 from google.appengine.api.datastore_errors import Error as GAEError
 from google.appengine.api.datastore_types import Key, Text
 from google.appengine.datastore.datastore_query import Cursor
 
+from djangotoolbox.fields import AbstractIterableField, RawField
 from djangotoolbox.db.basecompiler import (
+    EMULATED_OPS,
+    EmptyResultSet,
     NonrelQuery,
     NonrelCompiler,
     NonrelInsertCompiler,
@@ -24,8 +31,15 @@ from djangotoolbox.db.basecompiler import (
     NonrelDateCompiler,
     NonrelDateTimeCompiler)
 
-from .db_settings import get_model_indexes
+from .caching import CachedCount, CachedQuery, get_entities_async, \
+    invalidate_cache
+from .counters import get_counter_total, update_counter
+from .db_settings import get_model_indexes, get_model_query_cache, \
+    get_model_sharded_counter, setting_changed
 from .expressions import ExpressionEvaluator
+from .indexes import get_required_index
+from .recording import RPCRecorder
+from .signals import query_built, query_executed
 from .utils import commit_locked
 
 
@@ -55,6 +69,81 @@ NEGATION_MAP = {
     #       individual '<' and '>' queries).
 }
 
+# Options of set_config() handled by djangoappengine itself rather
+# than passed on to the datastore, with their default values.
+BACKEND_OPTIONS = {
+    # Number of entities read and written per batch by updates.
+    'update_batch_size': 500,
+
+    # Whether updates should change each entity in its own transaction;
+    # None to only use transactions for updates with F() expressions.
+    'transactional_update': None,
+
+    # Set to False to bypass the query cache configured for the model.
+    'query_cache': None,
+
+    # How to execute queries: "query" fetches whole entities with the
+    # query, "keys_then_get" runs a keys-only query and gets entities
+    # with batch Gets, which can be served by the entity cache.
+    'strategy': 'query',
+
+    # Set to True to fetch values(), values_list() and only() fields
+    # with projection queries where possible. They may need composite
+    # indexes, skip entities lacking a projected property and return a
+    # result per value of list properties, so they're opt-in.
+    'projection': False,
+
+    # Number of keys fetched per batch when counting results.
+    'count_batch_size': 1000,
+
+    # Number of seconds to cache counts in memcache for; counts cached
+    # this way ignore writes until they expire.
+    'count_cache': None,
+
+    # Number of entities deleted per Delete by deletes.
+    'delete_batch_size': 500,
+
+    # Name of a task queue to hand the batches of deletes to, instead
+    # of deleting entities in the request.
+    'delete_queue': None,
+
+    # Set to True to fetch results of queries excluding primary keys
+    # with sub-queries for the key ranges between them, so excluded
+    # entities aren't read at all. Such querysets don't return cursors.
+    'split_excluded_pks': False,
+}
+
+# Types of values that the datastore can return from indexes for
+# projection queries.
+PROJECTABLE_DB_TYPES = ('string', 'integer', 'long', 'float', 'boolean',
+                        'key', 'date', 'time', 'datetime', 'decimal')
+
+# Projection queries may return dates and times as microseconds since
+# the epoch.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Number of keys resolved per batch Get by the "keys_then_get" strategy
+# if no batch_size is configured.
+KEYS_THEN_GET_BATCH_SIZE = 100
+
+# Number of results the datastore returns per batch if neither a batch
+# size nor a limit is given; used to estimate RPC counts.
+DEFAULT_BATCH_SIZE = 20
+
+# Excluded primary keys are turned into key range sub-queries only if
+# this results in at most this many sub-queries.
+MAX_KEY_RANGE_QUERIES = 30
+
+# Maximum number of concurrent Delete RPCs sent by a delete.
+MAX_DELETE_RPCS = 10
+
+# Limits of the chunks of entities sent by inserts: the number of
+# entities and their estimated size in bytes, and the maximum number of
+# chunks sent concurrently.
+PUT_BATCH_SIZE = 500
+PUT_BATCH_BYTES = 1024 * 1024
+MAX_PUT_RPCS = 10
+
 # In some places None is an allowed value, and we need to distinguish
 # it from the lack of value.
 NOT_PROVIDED = object()
@@ -75,6 +164,206 @@ def safe_call(func):
     return _func
 
 
+def delete_entities(model, keys):
+    """
+    Deletes the entities with the given keys, updating caches and
+    counters; the deferred task used by deletes given a "delete_queue".
+    """
+    Delete(keys)
+    invalidate_cache(model, keys)
+    update_counter(model, -len(keys))
+
+
+def estimate_size(properties):
+    """
+    Returns a rough estimate of the encoded size in bytes of an entity
+    with the given properties.
+    """
+    size = 0
+    for name, value in properties.iteritems():
+        values = value if isinstance(value, (tuple, list)) else [value]
+        for value in values:
+            size += len(name) + 8
+            if isinstance(value, basestring):
+                size += len(value)
+    return size
+
+
+def split_config(config):
+    """
+    Separates djangoappengine's own options from the datastore
+    configuration set by set_config(), filling in option defaults.
+    """
+    config = dict(config or {})
+    options = dict((name, config.pop(name, default))
+                   for name, default in BACKEND_OPTIONS.iteritems())
+    return config, options
+
+
+class Descending(object):
+    """
+    Wraps a value reversing its ordering, for descending sort keys.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+
+class ParallelMultiQuery(object):
+    """
+    Runs the sub-queries generated for "__in" and negated "exact"
+    filters concurrently and merges their results in memory.
+
+    This replaces the SDK's MultiQuery, which runs sub-queries one
+    after another. Results are merged on the query ordering (using a
+    heap), duplicates are dropped and the offset is applied after
+    merging, so every sub-query is just limited to the end of the
+    requested slice.
+    """
+
+    def __init__(self, queries, ordering, keys_only=False):
+        self.queries = queries
+        self.ordering = ordering
+        self.keys_only = keys_only
+
+    def __repr__(self):
+        return '<ParallelMultiQuery: %r ORDER %r>' % (self.queries,
+                                                      self.ordering)
+
+    def Run(self, limit=None, offset=None, **kwargs):
+        offset = offset or 0
+        if limit is not None:
+            kwargs['limit'] = offset + limit
+
+        # Merging on properties needs whole entities.
+        fetch_keys = self.keys_only and any(
+            column != '__key__' for column, _ in self.ordering)
+        if fetch_keys:
+            kwargs['keys_only'] = False
+
+        # Query.Run sends the RPC for the first batch before returning,
+        # so all sub-queries get executed concurrently.
+        iterators = [query.Run(**kwargs) for query in self.queries]
+        results = self._merge(iterators)
+
+        if limit is not None:
+            results = islice(results, offset, offset + limit)
+        elif offset:
+            results = islice(results, offset, None)
+        if fetch_keys:
+            results = (entity.key() for entity in results)
+        return results
+
+    def _merge(self, iterators):
+        seen = set()
+        if not self.ordering:
+            for result in chain(*iterators):
+                key = self._get_key(result)
+                if key not in seen:
+                    seen.add(key)
+                    yield result
+            return
+
+        # K-way merge, each heap item holds the next result of one of
+        # the sub-queries (the index breaks sort key ties).
+        heap = []
+        for index, iterator in enumerate(iterators):
+            self._push(heap, index, iterator)
+        while heap:
+            _, index, result, iterator = heapq.heappop(heap)
+            self._push(heap, index, iterator)
+            key = self._get_key(result)
+            if key not in seen:
+                seen.add(key)
+                yield result
+
+    def _push(self, heap, index, iterator):
+        for result in iterator:
+            heapq.heappush(heap, (self._sort_key(result), index, result,
+                                  iterator))
+            break
+
+    def _get_key(self, result):
+        if isinstance(result, Key):
+            return result
+        return result.key()
+
+    def _sort_key(self, result):
+        sort_key = []
+        for column, direction in self.ordering:
+            if column == '__key__':
+                value = self._get_key(result)
+            else:
+                value = result.get(column)
+
+                # The datastore sorts entities with multiple values on
+                # the smallest one when ascending, largest one when
+                # descending.
+                if isinstance(value, list):
+                    if direction == Query.ASCENDING:
+                        value = min(value)
+                    else:
+                        value = max(value)
+            if direction == Query.DESCENDING:
+                value = Descending(value)
+            sort_key.append(value)
+
+        # Ties are ordered by key.
+        sort_key.append(self._get_key(result))
+        return tuple(sort_key)
+
+
+class KeyRangeQuery(object):
+    """
+    Runs the sub-queries for disjoint key ranges created for excluded
+    primary keys one after another, in the order of the results, each
+    one only if the previous ones didn't return enough results.
+    """
+
+    def __init__(self, queries, descending=False):
+        self.queries = queries
+        self.descending = descending
+
+    def __repr__(self):
+        return '<KeyRangeQuery: %r>' % (self.queries,)
+
+    def Run(self, limit=None, offset=None, **kwargs):
+        queries = self.queries
+        if self.descending:
+            queries = queries[::-1]
+        results = self._run(queries, limit, offset or 0, kwargs)
+        if offset:
+            results = islice(results, offset, None)
+        return results
+
+    def _run(self, queries, limit, offset, kwargs):
+        remaining = None
+        if limit is not None:
+            remaining = offset + limit
+        for query in queries:
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                kwargs['limit'] = remaining
+            for result in query.Run(**kwargs):
+                if remaining is not None:
+                    remaining -= 1
+                yield result
+
+
 class GAEQuery(NonrelQuery):
     """
     A simple App Engine query: no joins, no distinct, etc.
@@ -89,53 +378,45 @@ class GAEQuery(NonrelQuery):
         self.inequality_field = None
         self.included_pks = None
         self.excluded_pks = ()
+        self.key_ranges = False
         self.has_negated_exact_filter = False
         self.ordering = []
         self.db_table = self.query.get_meta().db_table
         self.pks_only = (len(fields) == 1 and fields[0].primary_key)
         start_cursor = getattr(self.query, '_gae_start_cursor', None)
         end_cursor = getattr(self.query, '_gae_end_cursor', None)
-        self.config = getattr(self.query, '_gae_config', {})
+        self.config, self.options = split_config(
+            getattr(self.query, '_gae_config', None))
         self.gae_query = [Query(self.db_table, keys_only=self.pks_only,
                                 cursor=start_cursor, end_cursor=end_cursor)]
+        self._prefetched = None
+        self._matcher = None
 
     # This is needed for debugging.
     def __repr__(self):
-        return '<GAEQuery: %r ORDER %r>' % (self.gae_query, self.ordering)
+        projection = self.get_projection()
+        if projection is None:
+            return '<GAEQuery: %r ORDER %r>' % (self.gae_query,
+                                                self.ordering)
+        return '<GAEQuery: %r ORDER %r PROJECTION %r>' % (
+            self.gae_query, self.ordering, projection)
 
     @safe_call
     def fetch(self, low_mark=0, high_mark=None):
-        query = self._build_query()
-        executed = False
-        if self.excluded_pks and high_mark is not None:
-            high_mark += len(self.excluded_pks)
-        if self.included_pks is not None:
-            results = self.get_matching_pk(low_mark, high_mark)
-        else:
-            if high_mark is None or high_mark > low_mark:
-                kw = {}
-                if self.config:
-                    kw.update(self.config)
-
-                if low_mark:
-                    kw['offset'] = low_mark
-                else:
-                    low_mark = 0
-
-                if high_mark:
-                    kw['limit'] = high_mark - low_mark
-
-                results = query.Run(**kw)
-                executed = True
-            else:
-                results = ()
+        results = self._fetch(low_mark, high_mark)
+        if query_executed.receivers:
+            results = self._record_iteration(results)
+        return results
 
-        if executed and not isinstance(query, MultiQuery):
-            def get_cursor():
-                return query.GetCursor()
-            self.query._gae_cursor = get_cursor
+    def _fetch(self, low_mark, high_mark):
+        prefetched = self._prefetched
+        self._prefetched = None
+        if prefetched is not None and prefetched[:2] == (low_mark, high_mark):
+            get_results = prefetched[2]
+        else:
+            get_results = self._run(low_mark, high_mark)
 
-        for entity in results:
+        for entity in get_results():
             if isinstance(entity, Key):
                 key = entity
             else:
@@ -144,31 +425,88 @@ class GAEQuery(NonrelQuery):
                 continue
             yield self._make_entity(entity)
 
+    @safe_call
+    def prefetch(self, low_mark=0, high_mark=None):
+        """
+        Sends the datastore RPCs needed to fetch the given slice of
+        results without waiting for them to complete. The next fetch()
+        of the same slice picks up the results.
+        """
+        self._prefetched = (low_mark, high_mark,
+                            self._run(low_mark, high_mark))
+
     @safe_call
     def count(self, limit=NOT_PROVIDED):
+        if query_executed.receivers:
+            return self._record('count', self._count, limit)
+        return self._count(limit)
+
+    def _count(self, limit):
+        # Like the datastore's Count(), count up to 1000 results unless
+        # the limit is given; None means no limit.
+        if limit is NOT_PROVIDED:
+            limit = 1000
+        if limit == 0:
+            return 0
         if self.included_pks is not None:
             return len(self.get_matching_pk(0, limit))
-        if self.excluded_pks:
-            return len(list(self.fetch(0, 2000)))
-        # The datastore's Count() method has a 'limit' kwarg, which has
-        # a default value (obviously).  This value can be overridden to
-        # anything you like, and importantly can be overridden to
-        # unlimited by passing a value of None.  Hence *this* method
-        # has a default value of NOT_PROVIDED, rather than a default
-        # value of None
-        kw = {}
-        if limit is not NOT_PROVIDED:
-            kw['limit'] = limit
-        return self._build_query().Count(**kw)
+
+        if self._counts_all_entities():
+            total = get_counter_total(self.query.model)
+            if total is not None:
+                return total if limit is None else min(total, limit)
+
+        cached_count = self._get_cached_count(limit)
+        if cached_count is not None:
+            count = cached_count.get()
+            if count is not None:
+                return count
+
+        count = sum(1 for _ in self._iter_keys(
+            self.options['count_batch_size'], limit))
+        if cached_count is not None:
+            cached_count.set(count)
+        return count
 
     @safe_call
     def delete(self):
+        """
+        Deletes the matching entities in batches, reading only their
+        keys. Batches are sent as concurrent async Deletes, or deferred
+        to the task queue given by the "delete_queue" option.
+        """
+        if query_executed.receivers:
+            self._record('delete', self._delete)
+        else:
+            self._delete()
+
+    def _delete(self):
+        model = self.query.model
+        batch_size = self.options['delete_batch_size']
+        queue = self.options['delete_queue']
         if self.included_pks is not None:
-            keys = [key for key in self.included_pks if key is not None]
+            keys = iter([key for key in self.included_pks
+                         if key is not None])
+            # Primary key filters can name entities that don't exist,
+            # which mustn't be subtracted from the model's counter.
+            if get_model_sharded_counter(model) is not None:
+                keys = self._iter_existing_keys(keys, batch_size)
         else:
-            keys = [key_dict[self.query.get_meta().pk.column] for key_dict in self.fetch()]
-        if keys:
-            Delete(keys)
+            keys = self._iter_keys(batch_size)
+
+        rpcs = deque()
+        batch = list(islice(keys, batch_size))
+        while batch:
+            if queue is not None:
+                from google.appengine.ext import deferred
+                deferred.defer(delete_entities, model, batch, _queue=queue)
+            else:
+                if len(rpcs) >= MAX_DELETE_RPCS:
+                    self._finish_delete(*rpcs.popleft())
+                rpcs.append((DeleteAsync(batch), batch))
+            batch = list(islice(keys, batch_size))
+        while rpcs:
+            self._finish_delete(*rpcs.popleft())
 
     @safe_call
     def order_by(self, ordering):
@@ -264,6 +602,176 @@ class GAEQuery(NonrelQuery):
 
         self._add_filter(field, op, value)
 
+    def get_projection(self):
+        """
+        Returns names of the properties to fetch with a projection
+        query, or None if whole entities have to be fetched.
+
+        Projections are only used if enabled by the "projection" option,
+        when a subset of fields is requested (e.g. through values() or
+        only()) and all of them are stored in indexes; properties with
+        equality filters can't be projected.
+        """
+        opts = self.query.get_meta()
+        if self.pks_only or not self.options['projection'] or \
+                len(self.fields) >= len(opts.fields):
+            return None
+
+        unindexed = get_model_indexes(self.query.model)['unindexed']
+        columns = []
+        for field in self.fields:
+            if field.primary_key:
+                continue
+            db_type = self.connection.creation.db_type(field)
+            if db_type not in PROJECTABLE_DB_TYPES or \
+                    field.name in unindexed:
+                return None
+            columns.append(field.column)
+
+        # Sub-query results are merged on their sort properties.
+        if len(self.gae_query) > 1:
+            for column, _ in self.ordering:
+                if column != '__key__' and column not in columns:
+                    columns.append(column)
+
+        for query in self.gae_query:
+            for column in columns:
+                if '%s =' % column in query:
+                    return None
+        return columns
+
+    def get_required_indexes(self):
+        """
+        Returns the composite indexes (see indexes.get_required_index)
+        needed by the datastore queries.
+        """
+        if self.included_pks is not None:
+            return []
+        projection = self.get_projection()
+        indexes = []
+        for query in self.gae_query:
+            index = get_required_index(self.db_table, query.keys(),
+                                       self.ordering, projection)
+            if index is not None and index not in indexes:
+                indexes.append(index)
+        return indexes
+
+    def get_fingerprint(self):
+        """
+        Returns a normalized description of the query's shape, leaving
+        out the values: the kind, the filter operators, the ordering and
+        whether multiple datastore queries are run.
+        """
+        if self.included_pks is not None:
+            filters = ['__key__ IN']
+        else:
+            filters = []
+        for query in self.gae_query:
+            for name in query:
+                if name not in filters:
+                    filters.append(name)
+        ordering = ['%s%s' % ('-' if direction == Query.DESCENDING else '',
+                              column)
+                    for column, direction in self.ordering]
+        fingerprint = '%s WHERE %s' % (self.db_table,
+                                       ' AND '.join(sorted(filters)) or '*')
+        if ordering:
+            fingerprint += ' ORDER BY %s' % ', '.join(ordering)
+        if len(self.gae_query) > 1:
+            fingerprint += ' MULTI'
+        if self.excluded_pks:
+            fingerprint += ' EXCLUDE KEYS'
+        return fingerprint
+
+    def explain(self, low_mark=0, high_mark=None):
+        """
+        Describes how the given slice of results would be fetched:
+
+        * strategy: "get" (batch Gets of primary keys), "query" or
+          "keys_then_get",
+        * sub_queries: filters of each datastore query,
+        * ordering and projection of the queries,
+        * indexes: composite indexes the queries need,
+        * in_memory: steps done in Python ("filter", "sort", "merge"
+          of sub-query results or "exclude" of primary keys),
+        * rpcs: estimated number of datastore RPCs,
+        * overfetch: estimated number of entities read per result
+          returned.
+
+        The estimates are None if the slice isn't bounded.
+        """
+        query = self._build_query(low_mark)
+        if isinstance(query, (ParallelMultiQuery, KeyRangeQuery)):
+            queries = query.queries
+        else:
+            queries = [query]
+        projection = self.get_projection()
+        plan = {'kind': self.db_table, 'ordering': list(self.ordering),
+                'projection': projection, 'sub_queries': [],
+                'indexes': [], 'in_memory': []}
+        returned = None
+        if high_mark is not None:
+            returned = max(high_mark - low_mark, 0)
+
+        if self.included_pks is not None:
+            plan['strategy'] = 'get'
+            keys = len(self.included_pks)
+            if any(self.gae_query):
+                plan['in_memory'].append('filter')
+            ordering = self.ordering and self.compiler._get_ordering()
+            sorted_on_pk = ordering and ordering[0][0].primary_key
+            if ordering and not sorted_on_pk:
+                plan['in_memory'].append('sort')
+            if high_mark is None or (ordering and not sorted_on_pk):
+                fetched = keys
+            else:
+                fetched = min(keys, high_mark)
+            # Chunks are fetched until enough entities match, so with
+            # filters in memory all of them may be needed.
+            chunk_size = max(self._get_pk_chunk_size(high_mark), 1)
+            if 'filter' in plan['in_memory']:
+                plan['rpcs'] = (keys + chunk_size - 1) // chunk_size
+            else:
+                plan['rpcs'] = (fetched + chunk_size - 1) // chunk_size
+        else:
+            keys_then_get = projection is None and \
+                self._use_keys_then_get(query)
+            plan['strategy'] = 'keys_then_get' if keys_then_get else 'query'
+            for sub_query in queries:
+                plan['sub_queries'].append(sorted(
+                    (name, repr(value)) for name, value in
+                        sub_query.iteritems()))
+            plan['indexes'] = self.get_required_indexes()
+            if isinstance(query, ParallelMultiQuery):
+                plan['in_memory'].append('merge')
+            if self.excluded_pks:
+                plan['in_memory'].append('exclude')
+
+            fetched = None
+            plan['rpcs'] = None
+            if high_mark is not None:
+                per_query = high_mark + len(self.excluded_pks)
+                batch_size = self.config.get('batch_size') or \
+                    per_query - low_mark or DEFAULT_BATCH_SIZE
+                batches = max(-(-per_query // batch_size), 1)
+                if isinstance(query, KeyRangeQuery):
+                    # Key ranges are only queried until the slice is
+                    # filled, which may take an RPC per range.
+                    fetched = per_query
+                    plan['rpcs'] = batches + len(queries) - 1
+                else:
+                    fetched = per_query * len(queries)
+                    plan['rpcs'] = batches * len(queries)
+                if keys_then_get:
+                    get_batch_size = self.config.get('batch_size') or \
+                        KEYS_THEN_GET_BATCH_SIZE
+                    plan['rpcs'] += -(-fetched // get_batch_size)
+
+        plan['overfetch'] = None
+        if returned and fetched is not None:
+            plan['overfetch'] = float(fetched) / returned
+        return plan
+
     # ----------------------------------------------
     # Internal API
     # ----------------------------------------------
@@ -307,6 +815,79 @@ class GAEQuery(NonrelQuery):
                 combined.append(self.gae_query[0])
         self.gae_query = combined
 
+    def _can_split_excluded_pks(self, low_mark=0):
+        """
+        Checks if excluded primary keys can be replaced with sub-queries
+        for the key ranges between them (see the "split_excluded_pks"
+        option). The sub-queries are run one after another, so this is
+        only possible for a single query, without inequality filters on
+        other properties, sorted on keys (or not at all), without an
+        offset and without cursors.
+        """
+        if not self.options['split_excluded_pks'] or low_mark or \
+                not self.excluded_pks or self.included_pks is not None or \
+                len(self.gae_query) != 1:
+            return False
+        if len(set(self.excluded_pks)) + 1 > MAX_KEY_RANGE_QUERIES:
+            return False
+        if any(column != '__key__' for column, _ in self.ordering):
+            return False
+        if getattr(self.query, '_gae_start_cursor', None) is not None or \
+                getattr(self.query, '_gae_end_cursor', None) is not None:
+            return False
+        for name in self.gae_query[0]:
+            column, op = name.rsplit(' ', 1)
+            if op != '=' and column != '__key__':
+                return False
+        return True
+
+    def _split_excluded_pks(self):
+        """
+        Replaces excluded primary keys with sub-queries for the key
+        ranges between them, in ascending key order, so the datastore
+        doesn't return entities that would just be dropped.
+        """
+        keys = sorted(set(self.excluded_pks), key=lambda key: key.to_path())
+        pk_field = self.query.get_meta().pk
+        ranges = [(None, keys[0])] + zip(keys, keys[1:]) + [(keys[-1], None)]
+        query = self.gae_query[0]
+        combined = []
+        for lower, upper in ranges:
+            self.gae_query = [Query(self.db_table, keys_only=self.pks_only)]
+            self.gae_query[0].update(dict(
+                (name, list(value) if isinstance(value, list) else value)
+                for name, value in query.iteritems()))
+            if lower is not None:
+                self._add_filter(pk_field, '>', lower)
+            if upper is not None:
+                self._add_filter(pk_field, '<', upper)
+            combined.append(self.gae_query[0])
+        self.gae_query = combined
+        self.excluded_pks = ()
+        self.key_ranges = True
+
+    def supports_cursors(self):
+        """
+        Checks if the results come from a single datastore query, so
+        fetching can be continued from a cursor.
+        """
+        return self.get_cursor_problem() is None
+
+    def get_cursor_problem(self):
+        """
+        Returns why the query can't be continued from a cursor, or None
+        if it can.
+        """
+        if self.included_pks is not None:
+            return "primary key lookups are done with batch Gets"
+        if len(self.gae_query) > 1:
+            return ("__in, OR or exclude() filters split it into several "
+                    "datastore queries")
+        if self._can_split_excluded_pks():
+            return ("exclude() on primary keys is split into key range "
+                    "queries (see the split_excluded_pks option)")
+        return None
+
     def _make_entity(self, entity):
         if isinstance(entity, Key):
             key = entity
@@ -318,49 +899,418 @@ class GAEQuery(NonrelQuery):
         return entity
 
     @safe_call
-    def _build_query(self):
+    def _build_query(self, low_mark=0):
+        if self._can_split_excluded_pks(low_mark):
+            self._split_excluded_pks()
         for query in self.gae_query:
             query.Order(*self.ordering)
+        query_built.send(sender=self.__class__, query=self)
+        if self.key_ranges:
+            return KeyRangeQuery(self.gae_query, descending=bool(
+                self.ordering and self.ordering[0][1] == Query.DESCENDING))
         if len(self.gae_query) > 1:
-            return MultiQuery(self.gae_query, self.ordering)
+            return ParallelMultiQuery(self.gae_query, self.ordering,
+                                      self.pks_only)
         return self.gae_query[0]
 
-    def get_matching_pk(self, low_mark=0, high_mark=None):
-        if not self.included_pks:
-            return []
+    def _run(self, low_mark, high_mark):
+        """
+        Sends the RPCs for the given slice of results and returns a
+        callable that waits for them and returns the results.
+
+        Query.Run issues the RPC for the first batch right away, so
+        only iterating over the results blocks.
+        """
+        query = self._build_query(low_mark)
+        if self.excluded_pks and high_mark is not None:
+            high_mark += len(self.excluded_pks)
+        if self.included_pks is not None:
+            return self._get_matching_pk_async(low_mark, high_mark)
+        if high_mark is not None and high_mark <= low_mark:
+            return lambda: ()
+
+        cached_query = self._get_cached_query(low_mark, high_mark)
+        if cached_query is not None:
+            cached = cached_query.get()
+            if cached is not None:
+                return self._use_cached_results(*cached)
+
+        kw = {}
+        if self.config:
+            kw.update(self.config)
+
+        if low_mark:
+            kw['offset'] = low_mark
+        else:
+            low_mark = 0
+
+        if high_mark:
+            kw['limit'] = high_mark - low_mark
+
+        projection = self.get_projection()
+        if projection is not None:
+            kw['projection'] = projection
+
+        keys_then_get = projection is None and \
+            self._use_keys_then_get(query)
+        if keys_then_get:
+            kw['keys_only'] = True
+
+        results = query.Run(**kw)
+        if keys_then_get:
+            results = self._get_entities_for_keys(results)
+        elif projection is not None:
+            results = self._convert_projected(results)
+
+        get_cursor = None
+        if isinstance(query, Query):
+            def get_cursor():
+                return query.GetCursor()
+            self.query._gae_cursor = get_cursor
 
+        if cached_query is not None:
+            return lambda: cached_query.collect(results, get_cursor)
+        return lambda: results
+
+    def _iter_keys(self, batch_size, limit=None):
+        """
+        Walks over the keys of the results with a keys-only query in
+        batches of the given size, skipping the excluded primary keys.
+        Results of multiple queries aren't returned in order.
+        """
+        query = self._build_query()
+        if isinstance(query, ParallelMultiQuery):
+            query = ParallelMultiQuery(query.queries, [], keys_only=True)
+
+        kw = dict(self.config)
+        kw['keys_only'] = True
+        kw['batch_size'] = batch_size
+        excluded_pks = set(self.excluded_pks)
+        if limit is not None:
+            kw['limit'] = limit + len(excluded_pks)
+
+        keys = (key for key in query.Run(**kw) if key not in excluded_pks)
+        if limit is not None:
+            keys = islice(keys, limit)
+        return keys
+
+    def _iter_existing_keys(self, keys, batch_size):
+        batch = list(islice(keys, batch_size))
+        while batch:
+            for entity in Get(batch):
+                if entity is not None:
+                    yield entity.key()
+            batch = list(islice(keys, batch_size))
+
+    def _finish_delete(self, rpc, keys):
+        rpc.get_result()
+        invalidate_cache(self.query.model, keys)
+        update_counter(self.query.model, -len(keys))
+
+    def _record(self, method, func, *args):
+        """
+        Calls func recording the datastore RPCs it makes, and sends
+        query_executed with the recorder afterwards.
+        """
+        recorder = RPCRecorder()
+        with recorder:
+            result = func(*args)
+        query_executed.send(sender=self.__class__, query=self, method=method,
+                            recorder=recorder, results=result)
+        return result
+
+    def _record_iteration(self, results):
+        """
+        Like _record, but for fetches: only the time spent getting each
+        result is recorded, not the RPCs made by the caller while
+        processing it.
+        """
+        recorder = RPCRecorder()
+        count = 0
+        while True:
+            with recorder:
+                try:
+                    result = results.next()
+                except StopIteration:
+                    break
+            count += 1
+            yield result
+        query_executed.send(sender=self.__class__, query=self, method='fetch',
+                            recorder=recorder, results=count)
+
+    def _counts_all_entities(self):
+        """
+        Checks if the query matches every entity of the model, so its
+        sharded counter (if any) can be used for counting.
+        """
+        return self.included_pks is None and not self.excluded_pks and \
+            len(self.gae_query) == 1 and not self.gae_query[0] and \
+            getattr(self.query, '_gae_start_cursor', None) is None and \
+            getattr(self.query, '_gae_end_cursor', None) is None
+
+    def _get_cached_count(self, limit):
+        """
+        Returns the memcache entry for the number of results, or None
+        if the count shouldn't be cached.
+        """
+        timeout = self.options['count_cache']
+        if not timeout or IsInTransaction():
+            return None
+        try:
+            sql, params = self.compiler.as_sql()
+        except (EmptyResultSet, DatabaseError):
+            return None
+        return CachedCount(self.query.model, timeout, sql, params, limit)
+
+    def _use_keys_then_get(self, query):
+        strategy = self.options['strategy']
+        if strategy not in ('query', 'keys_then_get'):
+            raise DatabaseError("Unknown query strategy %r." % strategy)
+        if strategy == 'query' or self.pks_only:
+            return False
+
+        # Merging results of multiple queries on properties needs whole
+        # entities.
+        return not isinstance(query, ParallelMultiQuery) or all(
+            column == '__key__' for column, _ in self.ordering)
+
+    def _get_entities_for_keys(self, keys):
+        """
+        Resolves keys returned by a keys-only query to entities, with a
+        batch Get per batch of keys. The next batch of keys is read
+        while the Get for the previous one is running.
+        """
+        config = self._get_config()
+        batch_size = self.config.get('batch_size') or \
+            KEYS_THEN_GET_BATCH_SIZE
+        keys = iter(keys)
+        batch = list(islice(keys, batch_size))
+        while batch:
+            get_entities = get_entities_async(self.query.model, batch,
+                                              **config)
+            batch = list(islice(keys, batch_size))
+            for entity in get_entities():
+                if entity is not None:
+                    yield entity
+
+    def _convert_projected(self, entities):
+        """
+        Turns projected dates and times returned as microseconds since
+        the epoch back into datetimes.
+        """
+        columns = [field.column for field in self.fields
+                   if not field.primary_key and
+                       self.connection.creation.db_type(field) in
+                           ('date', 'time', 'datetime')]
+        for entity in entities:
+            for column in columns:
+                value = entity.get(column)
+                if isinstance(value, (int, long)):
+                    entity[column] = EPOCH + datetime.timedelta(
+                        microseconds=value)
+            yield entity
+
+    def _get_config(self):
+        """
+        Returns the datastore configuration to use for batch Gets.
+        """
         config = self.config.copy()
 
         # batch_size is not allowed for Gets
-        if 'batch_size' in config:
-            del config['batch_size']
-
-        results = [result for result in Get(self.included_pks, **config)
-                   if result is not None and
-                       self.matches_filters(result)]
-        if self.ordering:
-            results.sort(cmp=self.order_pk_filtered)
-        if high_mark is not None and high_mark < len(results) - 1:
-            results = results[:high_mark]
-        if low_mark:
-            results = results[low_mark:]
-        return results
+        config.pop('batch_size', None)
+        return config
+
+    def _get_cached_query(self, low_mark, high_mark):
+        """
+        Returns the query cache entry for the given slice of results,
+        or None if results of this query shouldn't be cached.
+        """
+        options = get_model_query_cache(self.query.model)
+        if options is None or self.options['query_cache'] is False or \
+                IsInTransaction():
+            return None
+        try:
+            sql, params = self.compiler.as_sql()
+        except (EmptyResultSet, DatabaseError):
+            return None
+        return CachedQuery(self.query.model, options, self.pks_only,
+                           sql, params, low_mark, high_mark)
+
+    def _use_cached_results(self, results, cursor):
+        if results and not self.pks_only and isinstance(results[0], Key):
+            get_entities = get_entities_async(self.query.model, results,
+                                              **self._get_config())
+        else:
+            get_entities = lambda: results
+
+        if cursor is not None:
+            self.query._gae_cursor = lambda: cursor
+        return lambda: [entity for entity in get_entities()
+                        if entity is not None]
 
-    def order_pk_filtered(self, lhs, rhs):
-        left = dict(lhs)
-        left[self.query.get_meta().pk.column] = lhs.key().to_path()
-        right = dict(rhs)
-        right[self.query.get_meta().pk.column] = rhs.key().to_path()
-        return self._order_in_memory(left, right)
+    def get_matching_pk(self, low_mark=0, high_mark=None):
+        return self._get_matching_pk_async(low_mark, high_mark)()
+
+    def _get_pk_chunk_size(self, high_mark=None):
+        """
+        Returns the number of included primary keys fetched by each
+        batch Get of _get_matching_pk_async.
+        """
+        ordering = self.ordering and self.compiler._get_ordering()
+        if high_mark is None or (ordering and ordering[0][0].column !=
+                                 self.query.get_meta().pk.column):
+            return len(self.included_pks)
+        return high_mark
+
+    def _get_matching_pk_async(self, low_mark=0, high_mark=None):
+        """
+        Starts a batch Get for the included primary keys and returns a
+        callable that waits for it and returns the matching entities.
+
+        Unless the results have to be sorted on something else than the
+        primary key, keys are fetched in chunks of high_mark, in their
+        order, and only until enough entities match.
+        """
+        if not self.included_pks:
+            return lambda: []
+
+        keys = list(self.included_pks)
+        ordering = self.ordering and self.compiler._get_ordering()
+        if ordering and \
+                ordering[0][0].column == self.query.get_meta().pk.column:
+            keys.sort(key=lambda key: key.to_path(),
+                      reverse=not ordering[0][1])
+            ordering = None
+        chunk_size = self._get_pk_chunk_size(high_mark)
+
+        model = self.query.model
+        config = self._get_config()
+        get_entities = get_entities_async(model, keys[:chunk_size],
+                                          **config)
+
+        def get_results():
+            results = []
+            fetched = 0
+            get_chunk = get_entities
+            while True:
+                results.extend(entity for entity in get_chunk()
+                               if entity is not None and
+                                   self.matches_filters(entity))
+                fetched += chunk_size
+                if fetched >= len(keys) or \
+                        (high_mark is not None and len(results) >= high_mark):
+                    break
+                get_chunk = get_entities_async(
+                    model, keys[fetched:fetched + chunk_size], **config)
+
+            if ordering:
+                results = self.sort_in_memory(results)
+            if high_mark is not None:
+                results = results[:high_mark]
+            if low_mark:
+                results = results[low_mark:]
+            return results
+        return get_results
+
+    def sort_in_memory(self, entities):
+        """
+        Sorts GAE entities on the query ordering; does the same as
+        sorting with _order_in_memory, but extracts the values to
+        compare once per entity.
+        """
+        pk_column = self.query.get_meta().pk.column
+        ordering = self.compiler._get_ordering()
+        decorated = []
+        for entity in entities:
+            values = []
+            for field, _ in ordering:
+                if field.column == pk_column:
+                    values.append(entity.key().to_path())
+                else:
+                    values.append(entity.get(field.column))
+            decorated.append((values, entity))
+
+        # Sorts are stable, so sorting on the last column first leaves
+        # entities ordered on all of them.
+        for index in reversed(range(len(ordering))):
+            decorated.sort(key=lambda item: item[0][index],
+                           reverse=not ordering[index][1])
+        return [entity for _, entity in decorated]
+
+    def filters_non_pk_fields(self, filters=None):
+        """
+        Checks if the query's constraints involve other fields than the
+        primary key, which entities can stop matching when changed.
+        """
+        if filters is None:
+            filters = self.query.where
+        pk_column = self.query.get_meta().pk.column
+        for child in filters.children:
+            if isinstance(child, Node):
+                if self.filters_non_pk_fields(child):
+                    return True
+            elif self._decode_child(child)[0].column != pk_column:
+                return True
+        return False
 
     def matches_filters(self, entity):
         """
         Checks if the GAE entity fetched from the database satisfies
         the current query's constraints.
         """
-        item = dict(entity)
-        item[self.query.get_meta().pk.column] = entity.key()
-        return self._matches_filters(item, self.query.where)
+        if self._matcher is None:
+            self._matcher = self._compile_filters(self.query.where)
+        return self._matcher(entity)
+
+    def _compile_filters(self, filters):
+        """
+        Turns a WHERE tree into a function checking GAE entities the
+        same way as _matches_filters, decoding the constraints once.
+        """
+        # Filters without rules match everything.
+        if not filters.children:
+            return lambda entity: True
+
+        checks = []
+        for child in filters.children:
+            if isinstance(child, Node):
+                checks.append(self._compile_filters(child))
+            else:
+                checks.append(self._compile_constraint(child))
+
+        if filters.connector == OR:
+            match = lambda entity: any(check(entity) for check in checks)
+        else:
+            match = lambda entity: all(check(entity) for check in checks)
+        if filters.negated:
+            return lambda entity: not match(entity)
+        return match
+
+    def _compile_constraint(self, child):
+        field, lookup_type, lookup_value = self._decode_child(child)
+        operator = EMULATED_OPS[lookup_type]
+        column = field.column
+        if column == self.query.get_meta().pk.column:
+            get_value = lambda entity: entity.key()
+        else:
+            get_value = lambda entity: entity.get(column)
+
+        # Result for entities without a value, if it isn't computed by
+        # the operator.
+        none_match = None
+        if isinstance(lookup_value, (datetime.datetime, datetime.date,
+                                     datetime.time)):
+            none_match = lookup_type in ('lt', 'lte')
+        elif lookup_type in ('startswith', 'contains', 'endswith', 'iexact',
+                             'istartswith', 'icontains', 'iendswith'):
+            none_match = False
+
+        def check(entity):
+            value = get_value(entity)
+            if value is None and none_match is not None:
+                return none_match
+            return operator(value, lookup_value)
+        return check
 
 
 class SQLCompiler(NonrelCompiler):
@@ -369,6 +1319,41 @@ class SQLCompiler(NonrelCompiler):
     """
     query_class = GAEQuery
 
+    def build_query(self, fields=None):
+        # Reuse the query whose RPCs were started by prefetch_async().
+        query = getattr(self.query, '_gae_prefetched', None)
+        if query is not None:
+            del self.query._gae_prefetched
+            if fields is not None and query.fields == fields:
+                return query
+        return super(SQLCompiler, self).build_query(fields)
+
+    def _make_result(self, entity, fields):
+        """
+        Same as NonrelCompiler._make_result, but with the conversions
+        for the fields looked up once per query rather than per value.
+        """
+        if getattr(self, '_result_fields', None) is not fields:
+            self._result_fields = fields
+            self._result_converters = [
+                (field, field.column,
+                 self.ops.get_converter(field, 'from_db'))
+                for field in fields]
+
+        result = []
+        for field, column, convert in self._result_converters:
+            value = entity.get(column, NOT_PROVIDED)
+            if value is NOT_PROVIDED:
+                value = field.get_default()
+            else:
+                value = self.query.convert_values(convert(value), field,
+                                                  self.connection)
+            if value is None and not field.null:
+                raise IntegrityError("Non-nullable field %s can't be None!" %
+                                     field.name)
+            result.append(value)
+        return result
+
     def as_sql(self, *args, **kwargs):
         sql, params = super(SQLCompiler, self).as_sql(*args, **kwargs)
 
@@ -385,43 +1370,175 @@ class SQLCompiler(NonrelCompiler):
 
         return '%s --cursor:%s,%s' % (sql, start_cursor_str, end_cursor_str), params
 
+class WritePlan(object):
+    """
+    Everything inserts need to know to build entities of a model,
+    computed once per model and connection (see get_write_plan).
+    """
+
+    def __init__(self, model, connection):
+        opts = model._meta
+        self.ops = connection.ops
+        self.db_table = opts.db_table
+        self.pk_column = opts.pk.column
+        self.unindexed_columns = [
+            opts.get_field(name).column
+            for name in get_model_indexes(model)['unindexed']]
+
+        # GAE does not store empty lists (and even does not allow
+        # passing empty lists to Entity.update), so empty values of
+        # these columns are skipped.
+        self.list_columns = frozenset(
+            field.column for field in opts.fields
+            if isinstance(field, (AbstractIterableField, RawField)))
+
+        # Callables preparing values for storage by column.
+        self.converters = dict(
+            (field.column, self.ops.get_converter(field, 'for_db'))
+            for field in opts.fields)
+
+    def value_for_db(self, value, column):
+        """
+        Same as DatabaseOperations.value_for_db(value, field) for the
+        field of the column.
+        """
+        return self.converters[column](value)
+
+    def make_entity(self, data):
+        kwds = {'unindexed_properties': self.unindexed_columns}
+        properties = {}
+        for column, value in data.iteritems():
+            # The value will already be a db.Key, but the Entity
+            # constructor takes a name or id of the key, and will
+            # automatically create a new key if neither is given.
+            if column == self.pk_column:
+                if value is not None:
+                    kwds['id'] = value.id()
+                    kwds['name'] = value.name()
+
+            elif column in self.list_columns and \
+                    isinstance(value, (tuple, list)) and not value:
+                continue
+
+            # Use column names as property names.
+            else:
+                properties[column] = value
+
+        entity = Entity(self.db_table, **kwds)
+        entity.update(properties)
+        return entity, properties
+
+
+# Write plans by model and connection alias.
+_write_plans = {}
+
+
+def get_write_plan(model, connection):
+    key = (model, connection.alias)
+    plan = _write_plans.get(key)
+    if plan is None:
+        plan = _write_plans[key] = WritePlan(model, connection)
+    return plan
+
+
+def clear_write_plans(**kwargs):
+    _write_plans.clear()
+
+# Plans depend on settings, such as the indexes configured in
+# GAE_SETTINGS_MODULES or database options.
+setting_changed.connect(clear_write_plans)
+
+
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
 
+    def execute_sql(self, return_id=False):
+        # Same as NonrelInsertCompiler.execute_sql, but the values are
+        # prepared lazily, as insert() consumes them.
+        pk_field = self.query.get_meta().pk
+        key = self.insert(self._iter_values(), return_id=return_id)
+
+        # Pass the key value through normal database deconversion.
+        return self.ops.convert_values(
+            self.ops.value_from_db(key, pk_field), pk_field)
+
+    def _iter_values(self):
+        plan = get_write_plan(self.query.model, self.connection)
+        fields = [(field, field.column,
+                   not field.null and not field.primary_key)
+                  for field in self.query.fields]
+        for obj in self.query.objs:
+            field_values = {}
+            for field, column, required in fields:
+                if self.query.raw:
+                    value = getattr(obj, field.attname)
+                else:
+                    value = field.pre_save(obj, obj._state.adding)
+                value = field.get_db_prep_save(value,
+                                               connection=self.connection)
+                if value is None and required:
+                    raise IntegrityError("You can't set %s (a non-nullable "
+                                         "field) to None!" % field.name)
+
+                # Prepare value for database, note that query.values have
+                # already passed through get_db_prep_save.
+                field_values[column] = plan.value_for_db(value, column)
+            yield field_values
+
     @safe_call
     def insert(self, data_list, return_id=False):
-        opts = self.query.get_meta()
-        unindexed_fields = get_model_indexes(self.query.model)['unindexed']
-        unindexed_cols = [opts.get_field(name).column
-                          for name in unindexed_fields]
+        """
+        Puts entities for the given values (any iterable) and returns
+        the key of the first one.
 
-        entity_list = []
+        Entities are sent in chunks limited by PUT_BATCH_SIZE and
+        (roughly) PUT_BATCH_BYTES, with up to MAX_PUT_RPCS concurrent
+        async Puts, so only a few chunks are held in memory at a time.
+        """
+        plan = get_write_plan(self.query.model, self.connection)
+        keys = []
+        rpcs = deque()
+        chunk = []
+        chunk_bytes = 0
         for data in data_list:
-            properties = {}
-            kwds = {'unindexed_properties': unindexed_cols}
-            for column, value in data.items():
-                # The value will already be a db.Key, but the Entity
-                # constructor takes a name or id of the key, and will
-                # automatically create a new key if neither is given.
-                if column == opts.pk.column:
-                    if value is not None:
-                        kwds['id'] = value.id()
-                        kwds['name'] = value.name()
-
-                # GAE does not store empty lists (and even does not allow
-                # passing empty lists to Entity.update) so skip them.
-                elif isinstance(value, (tuple, list)) and not len(value):
-                    continue
-
-                # Use column names as property names.
-                else:
-                    properties[column] = value
-
-            entity = Entity(opts.db_table, **kwds)
-            entity.update(properties)
-            entity_list.append(entity)
-
-        keys = Put(entity_list)
-        return keys[0] if isinstance(keys, list) else keys
+            entity, properties = plan.make_entity(data)
+            entity_bytes = estimate_size(properties)
+            if chunk and (len(chunk) == PUT_BATCH_SIZE or
+                          chunk_bytes + entity_bytes > PUT_BATCH_BYTES):
+                if len(rpcs) == MAX_PUT_RPCS:
+                    keys.extend(self._finish_put(*rpcs.popleft()))
+                rpcs.append(self._put_async(chunk))
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(entity)
+            chunk_bytes += entity_bytes
+
+        if chunk:
+            rpcs.append(self._put_async(chunk))
+        while rpcs:
+            keys.extend(self._finish_put(*rpcs.popleft()))
+        return keys[0] if keys else None
+
+    def _put_async(self, entities):
+        """
+        Starts putting the entities, returning the RPC and the number of
+        them that are new. Entities with explicit keys are looked up
+        first if the model has a counter, so overwriting existing ones
+        doesn't count them again.
+        """
+        added = len(entities)
+        if get_model_sharded_counter(self.query.model) is not None:
+            keys = [entity.key() for entity in entities
+                    if entity.key().has_id_or_name()]
+            if keys:
+                added -= len([entity for entity in Get(keys)
+                              if entity is not None])
+        return PutAsync(entities), added
+
+    def _finish_put(self, rpc, added):
+        keys = rpc.get_result()
+        invalidate_cache(self.query.model, keys)
+        update_counter(self.query.model, added)
+        return keys
 
 
 class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
@@ -436,24 +1553,70 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
         return len(pks)
 
     def update_entities(self, pks, pk_field):
-        for pk in pks:
-            self.update_entity(pk[0], pk_field)
+        """
+        Changes entities in batches: one Get and one Put per batch.
+
+        Updates using F() expressions or filtering on other fields than
+        the primary key read, re-check and write each entity in its own
+        transaction instead, unless the "transactional_update" option
+        says otherwise.
+        """
+        self.update_query = self.build_query()
+        self.update_values = self.prepare_update_values()
+
+        options = self.update_query.options
+        transactional = options['transactional_update']
+        if transactional is None:
+            transactional = self.update_query.filters_non_pk_fields() or \
+                any(hasattr(value, 'evaluate')
+                    for _, value in self.update_values)
+        if transactional:
+            keys = []
+            for pk in pks:
+                keys.append(self.update_entity(pk[0], pk_field))
+            invalidate_cache(self.query.model,
+                                [key for key in keys if key is not None])
+            return
+
+        batch_size = options['update_batch_size']
+        for start in xrange(0, len(pks), batch_size):
+            keys = [self.ops.value_for_db(pk[0], pk_field)
+                    for pk in pks[start:start + batch_size]]
+            entities = [entity for entity in Get(keys)
+                        if entity is not None and
+                            self.update_query.matches_filters(entity)]
+            for entity in entities:
+                self.apply_update_values(entity)
+            if entities:
+                invalidate_cache(self.query.model, Put(entities))
 
     @commit_locked
     def update_entity(self, pk, pk_field):
-        gae_query = self.build_query()
         entity = Get(self.ops.value_for_db(pk, pk_field))
 
-        if not gae_query.matches_filters(entity):
+        if entity is None or not self.update_query.matches_filters(entity):
             return
 
+        self.apply_update_values(entity)
+        return Put(entity)
+
+    def prepare_update_values(self):
+        """
+        Returns (field, value) pairs with values prepared for saving;
+        done once for all entities changed by the update.
+        """
+        values = []
         for field, _, value in self.query.values:
             if hasattr(value, 'prepare_database_save'):
                 value = value.prepare_database_save(field)
             else:
                 value = field.get_db_prep_save(value,
                                                connection=self.connection)
+            values.append((field, value))
+        return values
 
+    def apply_update_values(self, entity):
+        for field, value in self.update_values:
             if hasattr(value, 'evaluate'):
                 assert not value.negated
                 value = ExpressionEvaluator(value, self.query, entity,
@@ -464,8 +1627,6 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
 
             entity[field.column] = self.ops.value_for_db(value, field)
 
-        Put(entity)
-
 
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
     pass
@@ -0,0 +1,86 @@
+"""
+Sharded counters keeping the number of entities of a model.
+
+Models opt in through the SHARDED_COUNTERS dict of GAE_SETTINGS_MODULES
+(see db_settings). The insert and delete compilers change a randomly
+chosen shard of the model's counter, so concurrent writes rarely
+contend for the same counter entity, and reading the total takes a
+single batch Get of all shards.
+"""
+
+import random
+
+from google.appengine.api.datastore import Entity, Get, Put, Query
+from google.appengine.api.datastore_types import Key
+from google.appengine.datastore.datastore_rpc import TransactionOptions
+
+from .db_settings import get_model_sharded_counter
+from .utils import commit_locked
+
+
+COUNTER_KIND = '_djangoappengine_counter'
+
+# Number of shards used if the model's options don't give one.
+DEFAULT_SHARDS = 20
+
+
+def get_counter_total(model):
+    """
+    Returns the number of entities of the model according to its
+    sharded counter, or None if the model isn't counted.
+    """
+    options = get_model_sharded_counter(model)
+    if options is None:
+        return None
+    shards = Get(_get_shard_keys(model, options))
+    return sum(shard['count'] for shard in shards if shard is not None)
+
+
+def update_counter(model, delta):
+    """
+    Adds delta to the model's sharded counter, if it has one.
+
+    The shard is changed in its own transaction, independent of any
+    transaction the calling code runs in.
+    """
+    options = get_model_sharded_counter(model)
+    if options is None or not delta:
+        return
+    _add_to_shard(random.choice(_get_shard_keys(model, options)), delta)
+
+
+def reset_counter(model, count=None):
+    """
+    Sets the model's counter to the given number, counting the existing
+    entities by default; use it when enabling the counter for a model
+    that already has data.
+    """
+    options = get_model_sharded_counter(model)
+    if options is None:
+        raise ValueError("%s isn't in SHARDED_COUNTERS." %
+                         model._meta.object_name)
+    if count is None:
+        query = Query(model._meta.db_table, keys_only=True)
+        count = sum(1 for _ in query.Run(batch_size=1000))
+    shards = []
+    for index, key in enumerate(_get_shard_keys(model, options)):
+        shard = Entity(COUNTER_KIND, name=key.name())
+        shard['count'] = count if index == 0 else 0
+        shards.append(shard)
+    Put(shards)
+
+
+@commit_locked(propagation=TransactionOptions.INDEPENDENT)
+def _add_to_shard(key, delta):
+    shard = Get([key])[0]
+    if shard is None:
+        shard = Entity(COUNTER_KIND, name=key.name())
+        shard['count'] = 0
+    shard['count'] += delta
+    Put(shard)
+
+
+def _get_shard_keys(model, options):
+    return [Key.from_path(COUNTER_KIND,
+                          '%s:%d' % (model._meta.db_table, index))
+            for index in range(options.get('shards', DEFAULT_SHARDS))]
@@ -1,6 +1,11 @@
 from django.conf import settings
 from django.utils.importlib import import_module
 
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
 # TODO: Add autodiscover() and make API more like dbindexer's
 #       register_index.
 
@@ -12,6 +17,12 @@ _MODULE_NAMES = getattr(settings, 'GAE_SETTINGS_MODULES', ())
 
 FIELD_INDEXES = None
 
+ENTITY_CACHE = None
+
+QUERY_CACHE = None
+
+SHARDED_COUNTERS = None
+
 
 def get_model_indexes(model):
     indexes = get_indexes()
@@ -26,8 +37,80 @@ def get_model_indexes(model):
 def get_indexes():
     global FIELD_INDEXES
     if FIELD_INDEXES is None:
-        field_indexes = {}
-        for name in _MODULE_NAMES:
-            field_indexes.update(import_module(name).FIELD_INDEXES)
-        FIELD_INDEXES = field_indexes
+        FIELD_INDEXES = _collect_settings('FIELD_INDEXES')
     return FIELD_INDEXES
+
+
+def get_model_entity_cache(model):
+    """
+    Returns entity cache options for the model or None if its entities
+    shouldn't be cached.
+    """
+    return _get_model_options(get_entity_cache(), model)
+
+
+def get_model_query_cache(model):
+    """
+    Returns query cache options for the model or None if results of
+    queries on it shouldn't be cached.
+    """
+    return _get_model_options(get_query_cache(), model)
+
+
+def get_model_sharded_counter(model):
+    """
+    Returns sharded counter options for the model or None if its
+    entities shouldn't be counted.
+    """
+    return _get_model_options(get_sharded_counters(), model)
+
+
+def get_entity_cache():
+    global ENTITY_CACHE
+    if ENTITY_CACHE is None:
+        ENTITY_CACHE = _collect_settings('ENTITY_CACHE')
+    return ENTITY_CACHE
+
+
+def get_query_cache():
+    global QUERY_CACHE
+    if QUERY_CACHE is None:
+        QUERY_CACHE = _collect_settings('QUERY_CACHE')
+    return QUERY_CACHE
+
+
+def get_sharded_counters():
+    global SHARDED_COUNTERS
+    if SHARDED_COUNTERS is None:
+        SHARDED_COUNTERS = _collect_settings('SHARDED_COUNTERS')
+    return SHARDED_COUNTERS
+
+
+def reload_settings(setting=None, **kwargs):
+    """
+    Forgets everything collected from GAE_SETTINGS_MODULES, so it gets
+    collected again when next needed.
+    """
+    global _MODULE_NAMES, FIELD_INDEXES, ENTITY_CACHE, QUERY_CACHE, \
+        SHARDED_COUNTERS
+    if setting not in (None, 'GAE_SETTINGS_MODULES'):
+        return
+    _MODULE_NAMES = getattr(settings, 'GAE_SETTINGS_MODULES', ())
+    FIELD_INDEXES = ENTITY_CACHE = QUERY_CACHE = SHARDED_COUNTERS = None
+
+setting_changed.connect(reload_settings)
+
+
+def _get_model_options(model_settings, model):
+    options = None
+    for item in reversed(model.mro()):
+        if item in model_settings:
+            options = dict(options or {}, **model_settings[item])
+    return options
+
+
+def _collect_settings(name):
+    collected = {}
+    for module_name in _MODULE_NAMES:
+        collected.update(getattr(import_module(module_name), name, {}))
+    return collected
@@ -0,0 +1,113 @@
+"""
+Derivation of the composite indexes datastore queries need.
+
+Indexes are represented as (kind, properties) tuples, with properties
+being a tuple of (name, direction) pairs and directions either "asc"
+or "desc", matching the index.yaml format.
+"""
+
+from google.appengine.api.datastore import Query
+
+
+INEQUALITY_OPERATORS = ('<', '<=', '>', '>=', '!=')
+
+
+def parse_filter(name):
+    """
+    Splits the name of a datastore Query filter ("property op") into
+    the property name and operator.
+    """
+    column, op = name.rsplit(' ', 1)
+    return column, op
+
+
+def get_required_index(kind, filters, ordering=(), projection=None):
+    """
+    Returns the composite index needed by a query on the kind with the
+    given filter names (the keys of a datastore Query), ordering (of
+    (property, Query.ASCENDING / DESCENDING) pairs) and projected
+    properties, or None if the built-in indexes suffice.
+    """
+    equality = []
+    inequality = []
+    for name in filters:
+        column, op = parse_filter(name)
+        if op == '=' and column not in equality:
+            equality.append(column)
+        elif op in INEQUALITY_OPERATORS and column not in inequality:
+            inequality.append(column)
+    equality.sort()
+
+    orders = [(column, 'asc' if direction == Query.ASCENDING else 'desc')
+              for column, direction in ordering if column not in equality]
+
+    # Entities are sorted on keys anyway.
+    while orders and orders[-1] == ('__key__', 'asc'):
+        orders.pop()
+
+    # The property with an inequality filter has to be sorted first.
+    inequality = [column for column in inequality if column != '__key__']
+    if inequality and (not orders or orders[0][0] != inequality[0]):
+        orders.insert(0, (inequality[0], 'asc'))
+
+    properties = [(column, 'asc') for column in equality] + orders
+    for column in projection or ():
+        if column not in [name for name, _ in properties]:
+            properties.append((column, 'asc'))
+
+    # Equality filters alone (possibly with key filters) are served by
+    # merging built-in single property indexes, and filters or sort
+    # orders on a single property by its built-in index.
+    if not orders and not projection:
+        return None
+    index = kind, tuple(properties)
+    if is_built_in(index):
+        return None
+    return index
+
+
+def is_built_in(index):
+    """
+    Checks if a composite index definition is served by a built-in
+    index anyway.
+    """
+    kind, properties = index
+    return len(properties) == 1 and properties[0][0] != '__key__'
+
+
+def read_index_file(path):
+    """
+    Returns the indexes defined in an index.yaml file, as a list of
+    (index, ancestor) pairs.
+    """
+    from google.appengine.datastore.datastore_index import \
+        ParseIndexDefinitions
+
+    try:
+        index_file = open(path)
+    except IOError:
+        return []
+    try:
+        definitions = ParseIndexDefinitions(index_file)
+    finally:
+        index_file.close()
+    if definitions is None or not definitions.indexes:
+        return []
+    return [((index.kind,
+              tuple((prop.name, prop.direction or 'asc')
+                    for prop in index.properties or ())),
+             bool(index.ancestor))
+            for index in definitions.indexes]
+
+
+def format_index(index):
+    """
+    Returns the index.yaml entry for the index.
+    """
+    kind, properties = index
+    lines = ['- kind: %s' % kind, '  properties:']
+    for name, direction in properties:
+        lines.append('  - name: %s' % name)
+        if direction == 'desc':
+            lines.append('    direction: desc')
+    return '\n'.join(lines)
@@ -0,0 +1,178 @@
+"""
+In-process statistics about executed queries, aggregated by their
+fingerprints (see GAEQuery.get_fingerprint).
+
+Enabled by the DATASTORE_QUERY_STATS setting: True (or "memcache")
+periodically merges the stats into memcache, so that all instances'
+stats can be viewed together, and "log" logs them instead. Queries
+slower than DATASTORE_SLOW_QUERY_THRESHOLD seconds are logged as
+warnings.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from google.appengine.api import memcache
+
+
+MEMCACHE_KEY = 'djangoappengine:querystats'
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last
+# bucket counts all slower queries.
+HISTOGRAM_BOUNDS = (0.01, 0.03, 0.1, 0.3, 1.0, 3.0)
+
+_lock = threading.Lock()
+_stats = {}
+_last_flush = time.time()
+
+
+class QueryStats(object):
+    """
+    Stats of the queries sharing a fingerprint.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rpcs = 0
+        self.results = 0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, seconds, rpcs, results):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rpcs += rpcs
+        self.results += results or 0
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS) and \
+                seconds > HISTOGRAM_BOUNDS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.rpcs += other.rpcs
+        self.results += other.results
+        self.histogram = [a + b for a, b in
+                          zip(self.histogram, other.histogram)]
+
+    @property
+    def average_seconds(self):
+        return self.seconds / self.count if self.count else 0.0
+
+
+def record_query(sender, query, method, recorder, results, **kwargs):
+    """
+    query_executed receiver adding the query to the stats.
+    """
+    global _last_flush
+    key = (method, query.get_fingerprint())
+    seconds = recorder.elapsed
+    _lock.acquire()
+    try:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = QueryStats()
+        stats.add(seconds, len(recorder.calls), results)
+        flush_now = time.time() - _last_flush >= getattr(
+            settings, 'DATASTORE_QUERY_STATS_FLUSH_INTERVAL', 60)
+        if flush_now:
+            _last_flush = time.time()
+    finally:
+        _lock.release()
+
+    threshold = getattr(settings, 'DATASTORE_SLOW_QUERY_THRESHOLD', None)
+    if threshold is not None and seconds >= threshold:
+        logging.warning("Slow query (%.1fms, %d RPCs): %s %s" % (
+            seconds * 1000, len(recorder.calls), method, query))
+    if flush_now:
+        flush()
+
+
+def flush():
+    """
+    Moves the stats collected by this instance to memcache or the log.
+    """
+    global _stats
+    _lock.acquire()
+    try:
+        stats, _stats = _stats, {}
+    finally:
+        _lock.release()
+    if not stats:
+        return
+
+    if getattr(settings, 'DATASTORE_QUERY_STATS', False) != 'log':
+        client = memcache.Client()
+        for _ in range(3):
+            cached = client.gets(MEMCACHE_KEY)
+            merged = _merge(cached or {}, stats)
+            if cached is None:
+                if client.add(MEMCACHE_KEY, merged):
+                    return
+            elif client.cas(MEMCACHE_KEY, merged):
+                return
+    logging.info("Query stats:\n%s" % format_stats(stats))
+
+
+def get_stats():
+    """
+    Returns all collected stats (after flushing this instance's), as a
+    dict mapping (method, fingerprint) to QueryStats.
+    """
+    flush()
+    if getattr(settings, 'DATASTORE_QUERY_STATS', False) == 'log':
+        return {}
+    return memcache.get(MEMCACHE_KEY) or {}
+
+
+def reset_stats():
+    global _stats
+    _lock.acquire()
+    try:
+        _stats = {}
+    finally:
+        _lock.release()
+    memcache.delete(MEMCACHE_KEY)
+
+
+def format_stats(stats):
+    """
+    Formats the stats as a table, most expensive fingerprints first.
+    """
+    bounds = ['<%gms' % (bound * 1000) for bound in HISTOGRAM_BOUNDS]
+    bounds.append('slower')
+    lines = []
+    for (method, fingerprint), item in sorted(
+            stats.items(), key=lambda item: -item[1].seconds):
+        lines.append('%s %s' % (method, fingerprint))
+        lines.append(
+            '    %d queries, %.1fms total, %.1fms average, %.1fms max, '
+            '%.1f RPCs and %.1f results per query' % (
+                item.count, item.seconds * 1000,
+                item.average_seconds * 1000, item.max_seconds * 1000,
+                float(item.rpcs) / item.count,
+                float(item.results) / item.count))
+        lines.append('    ' + ', '.join(
+            '%s: %d' % bucket for bucket in zip(bounds, item.histogram)))
+    return '\n'.join(lines)
+
+
+def _merge(stats, other):
+    merged = dict(stats)
+    for key, item in other.iteritems():
+        if key in merged:
+            combined = QueryStats()
+            combined.merge(merged[key])
+            combined.merge(item)
+            merged[key] = combined
+        else:
+            merged[key] = item
+    return merged
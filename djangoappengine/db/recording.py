@@ -0,0 +1,113 @@
+"""
+Recording of datastore RPCs through API proxy hooks.
+"""
+
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+HOOK_NAME = 'djangoappengine_recording'
+
+# Recorders active in the current thread.
+_local = threading.local()
+
+
+def _get_active():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+def _install_hooks():
+    """
+    Adds the recording hooks to the current API proxy (the test stubs
+    replace it, so this is checked every time a recorder starts).
+    """
+    proxy = apiproxy_stub_map.apiproxy
+    if getattr(proxy, '_djangoappengine_recording', False):
+        return
+    proxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call, 'datastore_v3')
+    proxy.GetPostCallHooks().Append(HOOK_NAME, _post_call, 'datastore_v3')
+    proxy._djangoappengine_recording = True
+
+
+def _pre_call(service, call, request, response):
+    recorders = _get_active()
+    if recorders:
+        _local.started = getattr(_local, 'started', {})
+        _local.started[id(response)] = time.time()
+
+
+def _post_call(service, call, request, response):
+    recorders = _get_active()
+    started = getattr(_local, 'started', {}).pop(id(response), None)
+    if not recorders or started is None:
+        return
+    seconds = time.time() - started
+    read, written = _count_entities(call, request, response)
+    for recorder in recorders:
+        recorder.calls.append((call, seconds, read, written))
+
+
+def _count_entities(call, request, response):
+    """
+    Returns the numbers of entities (or keys) read and written by a
+    datastore call.
+    """
+    if call == 'Get':
+        return len([entity for entity in response.entity_list()
+                    if entity.has_entity()]), 0
+    if call in ('RunQuery', 'Next'):
+        return response.result_size(), 0
+    if call == 'Put':
+        return 0, request.entity_size()
+    if call == 'Delete':
+        return 0, request.key_size()
+    return 0, 0
+
+
+class RPCRecorder(object):
+    """
+    Records the datastore RPCs made in the current thread while it's
+    active (used as a context manager) as (call, seconds, entities
+    read, entities written) tuples. It can be entered repeatedly;
+    "elapsed" sums up the wall time spent inside.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.elapsed = 0.0
+        self._started = None
+
+    def __enter__(self):
+        _install_hooks()
+        _get_active().append(self)
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _get_active().remove(self)
+        self.elapsed += time.time() - self._started
+
+    def get_counts(self):
+        """
+        Returns the number of RPCs by call name.
+        """
+        counts = {}
+        for call, _, _, _ in self.calls:
+            counts[call] = counts.get(call, 0) + 1
+        return counts
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds, _, _ in self.calls)
+
+    @property
+    def entities_read(self):
+        return sum(read for _, _, read, _ in self.calls)
+
+    @property
+    def entities_written(self):
+        return sum(written for _, _, _, written in self.calls)
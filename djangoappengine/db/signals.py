@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+
+# Sent by GAEQuery whenever it builds its datastore queries, with the
+# GAEQuery as "query".
+query_built = Signal(providing_args=['query'])
+
+# Sent by GAEQuery after running fetch(), count() or delete() (named by
+# "method"), if anyone listens, with the RPCRecorder that recorded the
+# datastore RPCs made meanwhile as "recorder" and the number of
+# entities fetched or counted as "results" (None for deletes).
+query_executed = Signal(providing_args=['query', 'method', 'recorder',
+                                        'results'])
@@ -13,6 +13,20 @@ REMOTE_API_SCRIPTS = (
 )
 
 
+# Services stubbed for tests by default. The DATABASES option
+# TEST_STUBS can give a leaner set, e.g. ('datastore_v3', 'memcache'),
+# with test modules declaring any other services they use through
+# StubManager.require_test_stubs.
+ALL_TEST_STUBS = (
+    'datastore_v3', 'memcache', 'taskqueue', 'urlfetch', 'user', 'xmpp',
+    'channel', 'app_identity', 'blobstore', 'files', 'images',
+)
+
+# Batch size of the queries and Puts taking and restoring datastore
+# snapshots.
+SNAPSHOT_BATCH_SIZE = 500
+
+
 def auth_func():
     import getpass
     return raw_input("Login via Google Account (see note above if login fails): "), getpass.getpass("Password: ")
@@ -30,6 +44,11 @@ class StubManager(object):
         self.testbed = None
         self.active_stubs = None
         self.pre_test_stubs = None
+        self.test_connection = None
+        self.test_datastore_path = None
+        self.test_environ = None
+        self.initialized_test_stubs = set()
+        self.required_test_stubs = set()
 
     def setup_stubs(self, connection):
         if self.active_stubs is not None:
@@ -66,10 +85,45 @@ class StubManager(object):
         self.testbed.activate()
         self.pre_test_stubs = self.active_stubs
         self.active_stubs = 'test'
+        self.test_connection = connection
+        self.test_datastore_path = datastore_path
+        self.initialized_test_stubs = set()
 
         os.environ['APPLICATION_ID'] = 'dev~' + appid
         os.environ['HTTP_HOST'] = "%s.appspot.com" % appid
 
+        services = connection.settings_dict.get('TEST_STUBS', ALL_TEST_STUBS)
+        self.init_test_stubs(*(tuple(services) +
+                               tuple(self.required_test_stubs)))
+        self.test_environ = dict(os.environ)
+
+    def require_test_stubs(self, *services):
+        """
+        Declares services needed by tests when TEST_STUBS limits the
+        test stubs to a lean profile. Test modules can call this at
+        import time, the stubs get initialized with the testbed (or
+        right away if it's active already).
+        """
+        self.required_test_stubs.update(services)
+        if self.active_stubs == 'test':
+            self.init_test_stubs(*services)
+
+    def init_test_stubs(self, *services, **kwargs):
+        reinit = kwargs.get('reinit', False)
+        for service in services:
+            if service in self.initialized_test_stubs and not reinit:
+                continue
+            if service == 'datastore_v3':
+                self._init_datastore_v3_stub()
+            elif service == 'taskqueue':
+                self.testbed.init_taskqueue_stub(auto_task_running=True,
+                                                 root_path=PROJECT_DIR)
+            else:
+                getattr(self.testbed, 'init_%s_stub' % service)()
+            self.initialized_test_stubs.add(service)
+
+    def _init_datastore_v3_stub(self):
+        connection = self.test_connection
         appserver_opts = connection.settings_dict.get('DEV_APPSERVER_OPTIONS', {})
         high_replication = appserver_opts.get('high_replication', False)
         require_indexes = appserver_opts.get('require_indexes', False)
@@ -81,22 +135,108 @@ class StubManager(object):
             from google.appengine.datastore import datastore_stub_util
             datastore_opts['consistency_policy'] = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
 
-        self.testbed.init_datastore_v3_stub(datastore_file=datastore_path, **datastore_opts)
-        self.testbed.init_memcache_stub()
-        self.testbed.init_taskqueue_stub(auto_task_running=True, root_path=PROJECT_DIR)
-        self.testbed.init_urlfetch_stub()
-        self.testbed.init_user_stub()
-        self.testbed.init_xmpp_stub()
-        self.testbed.init_channel_stub()
-        self.testbed.init_app_identity_stub()
-        self.testbed.init_blobstore_stub()
-        self.testbed.init_files_stub()
-        self.testbed.init_images_stub()
+        self.testbed.init_datastore_v3_stub(datastore_file=self.test_datastore_path, **datastore_opts)
+
+    def clear_test_stubs(self):
+        """
+        Resets the active test stubs and the environment variables
+        (e.g. USER_EMAIL) to their state after activation. The
+        datastore, memcache and task queues are emptied, which is a lot
+        faster than setting them up again; all other stubs are replaced
+        with new ones. Entities cached in process memory are dropped
+        too.
+        """
+        from .caching import clear_local_cache
+
+        clear_local_cache()
+        os.environ.clear()
+        os.environ.update(self.test_environ)
+        # Stubs depending on others (files on blobstore) come later in
+        # ALL_TEST_STUBS.
+        services = [service for service in ALL_TEST_STUBS
+                    if service in self.initialized_test_stubs]
+        services.extend(sorted(self.initialized_test_stubs -
+                               set(ALL_TEST_STUBS)))
+        self.init_test_stubs(*[
+            service for service in services
+            if service not in ('datastore_v3', 'memcache', 'taskqueue')],
+            reinit=True)
+        if 'datastore_v3' in self.initialized_test_stubs:
+            self.testbed.get_stub('datastore_v3').Clear()
+        if 'memcache' in self.initialized_test_stubs:
+            from google.appengine.api import memcache
+            memcache.flush_all()
+        if 'taskqueue' in self.initialized_test_stubs:
+            stub = self.testbed.get_stub('taskqueue')
+            for queue in stub.GetQueues():
+                stub.FlushQueue(queue['name'])
+
+    def take_datastore_snapshot(self):
+        """
+        Returns a copy of all entities in the datastore (of all
+        namespaces), e.g. after loading test fixtures.
+        """
+        from google.appengine.api.datastore import Query
+        from google.appengine.ext.db.metadata import get_namespaces
+
+        snapshot = []
+        for namespace in get_namespaces():
+            snapshot.extend(entity.ToPb() for entity in
+                            Query(namespace=namespace).Run(
+                                batch_size=SNAPSHOT_BATCH_SIZE))
+        return snapshot
+
+    def restore_datastore_snapshot(self, snapshot):
+        """
+        Empties the test stubs and puts the snapshot's entities back
+        with batch Puts, reserving their IDs so new entities don't get
+        them assigned.
+        """
+        from google.appengine.api.datastore import AllocateIdRange, \
+            Entity, Put
+        from google.appengine.api.datastore_types import Key
+
+        self.clear_test_stubs()
+        max_ids = {}
+        for start in range(0, len(snapshot), SNAPSHOT_BATCH_SIZE):
+            entities = [Entity.FromPb(pb) for pb in
+                        snapshot[start:start + SNAPSHOT_BATCH_SIZE]]
+            Put(entities)
+            for entity in entities:
+                key = entity.key()
+                if key.parent() is None and key.id() is not None:
+                    kind = (key.namespace(), key.kind())
+                    max_ids[kind] = max(max_ids.get(kind, 0), key.id())
+        for (namespace, kind), max_id in max_ids.items():
+            AllocateIdRange(Key.from_path(kind, 1, namespace=namespace),
+                            1, max_id)
+
+    def activate_worker_test_stubs(self, connection, worker):
+        """
+        Replaces the test stubs inherited by a forked test runner worker
+        with its own. File backed datastores get a separate file for
+        each worker, derived from the connection's datastore path.
+        """
+        from .base import destroy_datastore, get_datastore_paths
+
+        appserver_opts = connection.settings_dict.get('DEV_APPSERVER_OPTIONS', {})
+        datastore_path = self.test_datastore_path
+        if datastore_path is None and appserver_opts.get('use_sqlite', False):
+            datastore_path = get_datastore_paths(
+                connection.settings_dict)['datastore_path']
+        if datastore_path is not None:
+            datastore_path = '%s.worker%d' % (datastore_path, worker)
+            destroy_datastore({'datastore_path': datastore_path})
+
+        self.deactivate_test_stubs()
+        self.activate_test_stubs(connection, datastore_path)
 
     def deactivate_test_stubs(self):
         if self.active_stubs == 'test':
             self.testbed.deactivate()
             self.active_stubs = self.pre_test_stubs
+            self.test_environ = None
+            self.initialized_test_stubs = set()
 
     def setup_local_stubs(self, connection):
         if self.active_stubs == 'local':
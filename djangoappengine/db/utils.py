@@ -1,6 +1,12 @@
+import time
+import warnings
+
 from django.db import DEFAULT_DB_ALIAS
+from django.db.utils import DatabaseError
 
+from google.appengine.api.datastore_errors import Timeout
 from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.runtime.apiproxy_errors import DeadlineExceededError
 
 try:
     from functools import wraps
@@ -9,6 +15,10 @@ except ImportError:
 
 class CursorQueryMixin(object):
     def clone(self, *args, **kwargs):
+        if getattr(self, '_gae_prefetched', None) is not None:
+            warnings.warn("A queryset prefetched with prefetch_async() was "
+                          "copied before being evaluated; the copy runs "
+                          "its query again.", RuntimeWarning, stacklevel=3)
         kwargs['_gae_start_cursor'] = getattr(self, '_gae_start_cursor', None)
         kwargs['_gae_end_cursor'] = getattr(self, '_gae_end_cursor', None)
         kwargs['_gae_config'] = getattr(self, '_gae_config', None)
@@ -16,6 +26,10 @@ class CursorQueryMixin(object):
 
 def _add_mixin(queryset):
     if isinstance(queryset.query, CursorQueryMixin):
+        # Changes to a prefetched query wouldn't be used, so they go to
+        # a copy.
+        if getattr(queryset.query, '_gae_prefetched', None) is not None:
+            return queryset.all()
         return queryset
 
     queryset = queryset.all()
@@ -58,6 +72,191 @@ def set_config(queryset, **kwargs):
     setattr(queryset.query, '_gae_config', kwargs)
     return queryset
 
+def stream(queryset, batch_size=500, retries=3):
+    """
+    Iterates over all results of the queryset in batches of batch_size,
+    each fetched with a new query starting at the cursor where the
+    previous one ended. Only one batch is held in memory at a time and
+    a batch that times out is fetched again (up to `retries` times).
+
+    Use it instead of plain iteration to go through more results than
+    a single query can return before its deadline. Querysets that
+    can't be continued from cursors raise DatabaseError right away.
+    """
+    from djangotoolbox.db.basecompiler import EmptyResultSet
+
+    if queryset.query.low_mark or queryset.query.high_mark is not None:
+        raise ValueError("Sliced querysets can't be streamed.")
+
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    try:
+        gae_query = compiler.build_query(compiler.get_fields())
+    except EmptyResultSet:
+        return iter(())
+    problem = gae_query.get_cursor_problem()
+    if problem is not None:
+        raise DatabaseError("The query can't be streamed as it doesn't "
+                            "support cursors: %s." % problem)
+    return _stream(queryset, batch_size, retries)
+
+def _stream(queryset, batch_size, retries):
+    cursor = None
+    while True:
+        retry_delay = 0.1
+        for attempt in range(retries + 1):
+            batch = queryset.all()
+            if cursor is not None:
+                batch = set_cursor(batch, cursor)
+            batch = batch[:batch_size]
+            try:
+                len(batch)
+                break
+            except (Timeout, DeadlineExceededError):
+                if attempt == retries:
+                    raise
+                time.sleep(retry_delay)
+                retry_delay *= 2
+
+        for result in batch:
+            yield result
+        if len(batch) < batch_size:
+            return
+
+        cursor = get_cursor(batch)
+        if cursor is None:
+            raise DatabaseError("The query's cursor got lost, so it can't "
+                                "be streamed.")
+
+def prefetch_async(queryset):
+    """
+    Starts executing the queryset in the background, returning a copy
+    of it that waits for the results when first evaluated.
+
+    Use it to overlap the datastore round trips of several independent
+    querysets, for example:
+
+        authors = prefetch_async(Author.objects.filter(active=True))
+        posts = prefetch_async(Post.objects.order_by('-date')[:10])
+
+    Only the returned queryset itself uses the prefetched results;
+    copies of it (e.g. through filter() or set_cursor()) made before
+    it's evaluated run their own query and emit a RuntimeWarning.
+    """
+    from djangotoolbox.db.basecompiler import EmptyResultSet
+
+    queryset = _add_mixin(queryset.all())
+    query = queryset.query
+    compiler = query.get_compiler(using=queryset.db)
+    try:
+        gae_query = compiler.build_query(compiler.get_fields())
+    except EmptyResultSet:
+        return queryset
+    gae_query.prefetch(query.low_mark, query.high_mark)
+    query._gae_prefetched = gae_query
+    return queryset
+
+def prefetch_foreign_keys(objects, *field_names):
+    """
+    Fetches the objects referenced by the given ForeignKeys (all of
+    them by default) of a list of model instances with one batch Get
+    per related model, all running concurrently, and caches them on
+    the instances. Returns the instances as a list.
+
+    Use it instead of select_related(), which isn't supported, before
+    walking over the relations, e.g. in a template:
+
+        posts = prefetch_foreign_keys(Post.objects.all()[:50], 'author')
+    """
+    from django.db.models import ForeignKey
+
+    objects = list(objects)
+    if not objects:
+        return objects
+    opts = objects[0]._meta
+    if field_names:
+        fields = [opts.get_field(name) for name in field_names]
+    else:
+        fields = [field for field in opts.fields
+                  if isinstance(field, ForeignKey)]
+
+    # Fields referring to the same model share a Get, so collect the
+    # primary keys by related model first.
+    models = []
+    values = {}
+    for field in fields:
+        if not isinstance(field, ForeignKey):
+            raise ValueError("%s isn't a ForeignKey." % field.name)
+        related = field.rel.to
+        if field.rel.field_name != related._meta.pk.name:
+            raise ValueError("%s doesn't refer to a primary key." %
+                             field.name)
+        if related not in values:
+            models.append(related)
+            values[related] = set()
+        cache_name = field.get_cache_name()
+        for obj in objects:
+            value = getattr(obj, field.attname)
+            if value is not None and not hasattr(obj, cache_name):
+                values[related].add(value)
+
+    # Start all Gets first, so they run concurrently.
+    lookups = {}
+    for related in models:
+        if values[related]:
+            queryset = related._base_manager.using(
+                objects[0]._state.db).filter(pk__in=list(values[related]))
+            lookups[related] = prefetch_async(queryset)
+
+    for related, queryset in lookups.items():
+        lookups[related] = dict((obj.pk, obj) for obj in queryset)
+    for field in fields:
+        related = lookups.get(field.rel.to)
+        if not related:
+            continue
+        cache_name = field.get_cache_name()
+        for obj in objects:
+            value = getattr(obj, field.attname)
+            if value in related and not hasattr(obj, cache_name):
+                setattr(obj, cache_name, related[value])
+    return objects
+
+def explain(queryset, execute=False):
+    """
+    Returns a dict describing how the queryset would be executed (see
+    GAEQuery.explain), e.g. for checking expensive queries in tests:
+
+        plan = explain(Post.objects.filter(tags='django').order_by('-date'))
+        self.assertEqual(plan['indexes'], [])
+
+    With execute=True the queryset is also evaluated, and the actual
+    RPCs are added under "executed" with the number of results, RPC
+    counts by call, entities read and total seconds.
+    """
+    from djangotoolbox.db.basecompiler import EmptyResultSet
+    from .recording import RPCRecorder
+
+    queryset = queryset.all()
+    query = queryset.query
+    compiler = query.get_compiler(using=queryset.db)
+    try:
+        gae_query = compiler.build_query(compiler.get_fields())
+    except EmptyResultSet:
+        return {'kind': query.get_meta().db_table, 'strategy': None,
+                'ordering': [], 'projection': None, 'sub_queries': [],
+                'indexes': [], 'in_memory': [], 'rpcs': 0,
+                'overfetch': None}
+    plan = gae_query.explain(query.low_mark, query.high_mark)
+
+    if execute:
+        start = time.time()
+        with RPCRecorder() as recorder:
+            results = len(queryset.all())
+        plan['executed'] = {'results': results,
+                            'rpcs': recorder.get_counts(),
+                            'entities_read': recorder.entities_read,
+                            'seconds': time.time() - start}
+    return plan
+
 def commit_locked(func_or_using=None, retries=None, xg=False, propagation=None):
     """
     Decorator that locks rows on DB reads.
@@ -0,0 +1,102 @@
+import os
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...boot import PROJECT_DIR
+
+
+class Command(BaseCommand):
+    """
+    Runs the tests recording the datastore queries they build, derives
+    the composite indexes those need and compares them with the ones
+    defined in index.yaml.
+
+    Indexes needed but not defined are printed in the index.yaml format
+    (and can be appended to the file with --write). Defined indexes are
+    reported as unused if no recorded query needs them and as redundant
+    if they're duplicated or served by built-in indexes anyway; every
+    index slows down writes, so consider removing them, but keep in
+    mind that only queries run by the tests are taken into account.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--index-file', action='store', dest='index_file',
+            default=os.path.join(PROJECT_DIR, 'index.yaml'),
+            help='The index.yaml file to check.'),
+        make_option('--write', action='store_true', dest='write',
+            default=False,
+            help='Append the missing indexes to the index.yaml file.'),
+    )
+    help = "Checks index.yaml against the queries run by the tests."
+    args = '[appname ...]'
+
+    requires_model_validation = False
+
+    def handle(self, *test_labels, **options):
+        from django.test.utils import get_runner
+        from ...db.indexes import format_index, is_built_in, \
+            read_index_file
+        from ...db.signals import query_built
+
+        needed = []
+
+        def record(sender, query, **kwargs):
+            for index in query.get_required_indexes():
+                if index not in needed:
+                    needed.append(index)
+
+        query_built.connect(record)
+        try:
+            test_runner = get_runner(settings)(
+                verbosity=int(options.get('verbosity', 1)),
+                interactive=False)
+            failures = test_runner.run_tests(test_labels)
+        finally:
+            query_built.disconnect(record)
+        if failures:
+            self.stderr.write("Some tests failed, queries they didn't get "
+                              "to run aren't taken into account.\n")
+
+        index_file = options['index_file']
+        defined = []
+        redundant = []
+        unused = []
+        for index, ancestor in read_index_file(index_file):
+            if (index, ancestor) in defined or \
+                    (not ancestor and is_built_in(index)):
+                redundant.append(index)
+            elif ancestor or index not in needed:
+                unused.append(index)
+            defined.append((index, ancestor))
+        missing = [index for index in needed
+                   if (index, False) not in defined]
+
+        for title, indexes in (("Missing", missing), ("Unused", unused),
+                               ("Redundant", redundant)):
+            if not indexes:
+                continue
+            self.stdout.write("%s indexes:\n\n" % title)
+            for index in indexes:
+                self.stdout.write(format_index(index) + '\n')
+            self.stdout.write('\n')
+        if not missing and not unused and not redundant:
+            self.stdout.write("%s matches the recorded queries.\n" %
+                              index_file)
+
+        if missing and options['write']:
+            exists = os.path.exists(index_file)
+            output = open(index_file, 'a')
+            try:
+                if not exists:
+                    output.write('indexes:\n')
+                output.write('\n'.join(format_index(index)
+                                       for index in missing) + '\n')
+            finally:
+                output.close()
+            self.stdout.write("Added %d indexes to %s.\n" %
+                              (len(missing), index_file))
+
+        if failures or (missing and not options['write']):
+            sys.exit(1)
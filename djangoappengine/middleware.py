@@ -0,0 +1,140 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .db.recording import RPCRecorder
+from .db.signals import query_executed
+
+
+# The RPC recorder of the current thread's request and the queries it
+# executed, if the middleware is recording them.
+_local = threading.local()
+
+
+class RPCBudgetExceeded(Exception):
+    pass
+
+
+def rpc_budget(rpcs=None, entities_read=None, entities_written=None):
+    """
+    Sets limits on the datastore RPCs a view makes and the entities it
+    reads and writes per request, enforced by DatastoreStatsMiddleware.
+    They override the DATASTORE_RPC_BUDGET setting.
+    """
+    budget = {'rpcs': rpcs, 'entities_read': entities_read,
+              'entities_written': entities_written}
+
+    def _decorator(view):
+        view.rpc_budget = budget
+        return view
+    return _decorator
+
+
+def record_query(sender, query, method, recorder, results, **kwargs):
+    queries = getattr(_local, 'queries', None)
+    if queries is not None:
+        queries.append((repr(query), method, len(recorder.calls),
+                        recorder.elapsed, results))
+
+
+class DatastoreStatsMiddleware(object):
+    """
+    Counts the datastore RPCs, the entities read and written and the
+    time spent waiting for the datastore per request. That's the sum of
+    the RPCs' durations, which exceeds the wall time when RPCs run
+    concurrently, so the request's wall time is reported too.
+
+    The numbers are added to the response as X-Datastore-* headers if
+    DATASTORE_STATS_HEADERS is set (defaults to DEBUG) and logged
+    (together with every query executed) if DATASTORE_STATS_LOG is set.
+    Requests exceeding the view's rpc_budget or the DATASTORE_RPC_BUDGET
+    setting (a dict with the same keys as rpc_budget's arguments) log a
+    warning, or raise RPCBudgetExceeded when DEBUG is on.
+    """
+
+    def __init__(self):
+        self.headers = getattr(settings, 'DATASTORE_STATS_HEADERS',
+                               settings.DEBUG)
+        self.log = getattr(settings, 'DATASTORE_STATS_LOG', False)
+        self.budget = getattr(settings, 'DATASTORE_RPC_BUDGET', None) or {}
+        for name in self.budget:
+            if name not in ('rpcs', 'entities_read', 'entities_written'):
+                raise ImproperlyConfigured(
+                    "Unknown DATASTORE_RPC_BUDGET limit: %s." % name)
+        if self.log:
+            query_executed.connect(record_query)
+
+    def process_request(self, request):
+        # Stops a recorder left active by an earlier request on this
+        # thread whose response never got processed.
+        self._stop_recording()
+        if self.log:
+            _local.queries = []
+        recorder = RPCRecorder()
+        request._datastore_recorder = recorder
+        _local.recorder = recorder
+        recorder.__enter__()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._datastore_budget = getattr(view_func, 'rpc_budget', None)
+
+    def process_exception(self, request, exception):
+        # process_response isn't called unless some middleware turns the
+        # exception into a response.
+        self._stop_recording()
+
+    def _stop_recording(self):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is not None:
+            _local.recorder = None
+            recorder.__exit__(None, None, None)
+
+    def process_response(self, request, response):
+        recorder = getattr(request, '_datastore_recorder', None)
+        if recorder is None:
+            return response
+        del request._datastore_recorder
+        if getattr(_local, 'recorder', None) is recorder:
+            self._stop_recording()
+        queries = getattr(_local, 'queries', None)
+        _local.queries = None
+
+        counts = recorder.get_counts()
+        rpcs = ', '.join('%s=%d' % item for item in sorted(counts.items()))
+        stats = {'rpcs': len(recorder.calls),
+                 'entities_read': recorder.entities_read,
+                 'entities_written': recorder.entities_written}
+        if self.headers:
+            response['X-Datastore-RPCs'] = rpcs or 'none'
+            response['X-Datastore-Entities'] = 'read=%d, written=%d' % (
+                stats['entities_read'], stats['entities_written'])
+            response['X-Datastore-Time'] = '%.1fms' % (recorder.seconds * 1000)
+            response['X-Request-Time'] = '%.1fms' % (recorder.elapsed * 1000)
+        if self.log:
+            lines = ['%s %s: %d RPCs (%s), read %d and wrote %d entities, '
+                     '%.1fms in RPCs, %.1fms in total' % (
+                         request.method, request.path, stats['rpcs'],
+                         rpcs or 'none', stats['entities_read'],
+                         stats['entities_written'], recorder.seconds * 1000,
+                         recorder.elapsed * 1000)]
+            for query in queries or ():
+                lines.append('  %s %s: %d RPCs, %.1fms, %r results' % (
+                    query[1], query[0], query[2], query[3] * 1000, query[4]))
+            logging.info('\n'.join(lines))
+
+        budget = dict(self.budget)
+        budget.update((name, limit) for name, limit in
+                      (getattr(request, '_datastore_budget', None) or {})
+                      .items() if limit is not None)
+        exceeded = ['%s: %d > %d' % (name, stats[name], limit)
+                    for name, limit in sorted(budget.items())
+                    if limit is not None and stats[name] > limit]
+        if exceeded:
+            message = 'Datastore budget exceeded by %s %s (%s).' % (
+                request.method, request.path, ', '.join(exceeded))
+            if settings.DEBUG:
+                raise RPCBudgetExceeded(message)
+            logging.warning(message)
+        return response
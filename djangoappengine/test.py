@@ -0,0 +1,217 @@
+from cStringIO import StringIO
+import cPickle as pickle
+import os
+import sys
+import time
+import traceback
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TestCase
+from django.utils.unittest import TestSuite, TextTestRunner
+
+try:
+    from django.test.runner import DiscoverRunner as TestRunner
+except ImportError:
+    from django.test.simple import DjangoTestSuiteRunner as TestRunner
+
+from .db.stubs import stub_manager
+
+
+class DatastoreSnapshotMixin(object):
+    """
+    Loads a test case class' fixtures only before its first test and
+    takes a snapshot of the datastore afterwards, which is restored
+    before each following test instead of going through loaddata (and
+    the ORM) again.
+
+    Use it (or SnapshotTestCase) for test cases with large fixtures.
+    Only works with the test stubs.
+    """
+
+    def _fixture_setup(self):
+        cls = self.__class__
+        if stub_manager.active_stubs != 'test':
+            return super(DatastoreSnapshotMixin, self)._fixture_setup()
+        snapshot = cls.__dict__.get('_datastore_snapshot')
+        if snapshot is None:
+            super(DatastoreSnapshotMixin, self)._fixture_setup()
+            cls._datastore_snapshot = stub_manager.take_datastore_snapshot()
+        else:
+            stub_manager.restore_datastore_snapshot(snapshot)
+
+    @classmethod
+    def tearDownClass(cls):
+        if '_datastore_snapshot' in cls.__dict__:
+            del cls._datastore_snapshot
+        super(DatastoreSnapshotMixin, cls).tearDownClass()
+
+
+class SnapshotTestCase(DatastoreSnapshotMixin, TestCase):
+    pass
+
+
+class ParallelTestResult(object):
+    """
+    The aggregated results of the test runner workers, with failures
+    and errors as (test description, traceback) pairs.
+    """
+
+    def __init__(self):
+        self.testsRun = 0
+        self.failures = []
+        self.errors = []
+        self.skipped = 0
+        self.expectedFailures = 0
+        self.unexpectedSuccesses = 0
+
+    def add(self, results):
+        self.testsRun += results['tests_run']
+        self.failures.extend(results['failures'])
+        self.errors.extend(results['errors'])
+        self.skipped += results['skipped']
+        self.expectedFailures += results['expected_failures']
+        self.unexpectedSuccesses += results['unexpected_successes']
+
+    def wasSuccessful(self):
+        return not self.failures and not self.errors
+
+
+def split_suite(suite, workers):
+    """
+    Splits the tests of a suite into a suite for each worker, keeping
+    the tests of a class together (and in order) so class level setup
+    runs only once.
+    """
+    groups = []
+    classes = {}
+    pending = [suite]
+    while pending:
+        test = pending.pop(0)
+        if isinstance(test, TestSuite):
+            pending[:0] = list(test)
+            continue
+        if test.__class__ not in classes:
+            classes[test.__class__] = []
+            groups.append(classes[test.__class__])
+        classes[test.__class__].append(test)
+
+    suites = [TestSuite() for _ in range(workers)]
+    for group in sorted(groups, key=len, reverse=True):
+        smallest = min(suites, key=lambda suite: suite.countTestCases())
+        smallest.addTests(group)
+    return [suite for suite in suites if suite.countTestCases()]
+
+
+class ParallelTestSuiteRunner(TestRunner):
+    """
+    Runs the tests in TEST_WORKERS forked processes (one per CPU by
+    default), each with its own test stubs and datastore, and reports
+    the aggregated results.
+    """
+
+    def run_suite(self, suite, **kwargs):
+        workers = getattr(settings, 'TEST_WORKERS', None)
+        if workers is None:
+            try:
+                import multiprocessing
+                workers = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                workers = 1
+        suites = split_suite(suite, max(workers, 1))
+        if len(suites) < 2 or not hasattr(os, 'fork'):
+            return TextTestRunner(verbosity=self.verbosity,
+                                  failfast=self.failfast).run(suite)
+
+        start = time.time()
+        children = []
+        for worker, worker_suite in enumerate(suites):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                self.run_worker(worker, worker_suite, write_fd)
+            os.close(write_fd)
+            children.append((pid, read_fd))
+
+        result = ParallelTestResult()
+        output = []
+        for worker, (pid, read_fd) in enumerate(children):
+            pipe = os.fdopen(read_fd, 'rb')
+            try:
+                data = pipe.read()
+            finally:
+                pipe.close()
+            os.waitpid(pid, 0)
+            if not data:
+                result.errors.append(("worker %d" % worker,
+                                      "The worker process died."))
+                continue
+            results = pickle.loads(data)
+            result.add(results)
+            output.append(results['output'])
+        self.print_result(result, output, time.time() - start)
+        return result
+
+    def run_worker(self, worker, suite, write_fd):
+        """
+        Runs a worker's tests in the forked process and writes the
+        results to the pipe.
+        """
+        try:
+            stub_manager.activate_worker_test_stubs(
+                connections[DEFAULT_DB_ALIAS], worker)
+            stream = StringIO()
+            result = TextTestRunner(stream=stream, verbosity=self.verbosity,
+                                    failfast=self.failfast).run(suite)
+            results = {
+                'tests_run': result.testsRun,
+                'failures': [(str(test), trace)
+                             for test, trace in result.failures],
+                'errors': [(str(test), trace)
+                           for test, trace in result.errors],
+                'skipped': len(getattr(result, 'skipped', ())),
+                'expected_failures':
+                    len(getattr(result, 'expectedFailures', ())),
+                'unexpected_successes':
+                    len(getattr(result, 'unexpectedSuccesses', ())),
+                'output': stream.getvalue(),
+            }
+            pipe = os.fdopen(write_fd, 'wb')
+            pipe.write(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+            pipe.close()
+        except:
+            traceback.print_exc()
+        os._exit(0)
+
+    def print_result(self, result, output, seconds):
+        stream = sys.stderr
+        if self.verbosity > 1:
+            for worker_output in output:
+                stream.write(worker_output)
+        for flavour, errors in (('ERROR', result.errors),
+                                ('FAIL', result.failures)):
+            for test, trace in errors:
+                stream.write('=' * 70 + '\n')
+                stream.write('%s: %s\n' % (flavour, test))
+                stream.write('-' * 70 + '\n')
+                stream.write('%s\n' % trace)
+        stream.write('-' * 70 + '\n')
+        stream.write('Ran %d tests in %.3fs with %d workers\n\n' % (
+            result.testsRun, seconds, len(output)))
+        infos = []
+        if result.failures:
+            infos.append('failures=%d' % len(result.failures))
+        if result.errors:
+            infos.append('errors=%d' % len(result.errors))
+        if result.skipped:
+            infos.append('skipped=%d' % result.skipped)
+        if result.expectedFailures:
+            infos.append('expected failures=%d' % result.expectedFailures)
+        if result.unexpectedSuccesses:
+            infos.append('unexpected successes=%d' %
+                         result.unexpectedSuccesses)
+        status = result.wasSuccessful() and 'OK' or 'FAILED'
+        if infos:
+            status += ' (%s)' % ', '.join(infos)
+        stream.write(status + '\n')
@@ -1,10 +1,17 @@
 from .test_backend import BackendTest
+from .test_benchmarks import WritePlanBenchmark
+from .test_caching import EntityCacheTest, KeysThenGetTest, QueryCacheTest
+from .test_counters import CountTest, ShardedCounterTest
 from .test_field_db_conversion import FieldDBConversionTest
 from .test_field_options import FieldOptionsTest
 from .test_filter import FilterTest
+from .test_indexes import IndexesTest
 from .test_keys import KeysTest
 from .test_mapreduce import DjangoModelInputReaderTest, DjangoModelIteratorTest
+from .test_middleware import DatastoreStatsMiddlewareTest, QueryStatsTest
 from .test_not_return_sets import NonReturnSetsTest
 from .test_order import OrderTest
+from .test_runner import ParallelTestRunnerTest
 from .test_transactions import TransactionTest
 from .test_storage import BlobstoreStorageTest, GSStorageTest
+from .test_stubs import DatastoreSnapshotTest, FlushTest
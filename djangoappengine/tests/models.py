@@ -2,7 +2,8 @@ from django.db import models
 
 from djangotoolbox.fields import BlobField
 
-from ..db.db_settings import get_indexes
+from ..db.db_settings import get_entity_cache, get_indexes, \
+    get_query_cache, get_sharded_counters
 
 
 class EmailModel(models.Model):
@@ -90,6 +91,11 @@ class OrderedModel(models.Model):
         ordering = ('-priority',)
 
 
+class OrderedPairModel(models.Model):
+    first = models.ForeignKey(OrderedModel, related_name='+')
+    second = models.ForeignKey(OrderedModel, related_name='+')
+
+
 class BlobModel(models.Model):
     data = BlobField()
 
@@ -100,3 +106,27 @@ class SelfReferenceModel(models.Model):
 
 class NullableTextModel(models.Model):
     text = models.TextField(null=True)
+
+
+class CachedModel(models.Model):
+    value = models.IntegerField()
+
+get_entity_cache()[CachedModel] = {'timeout': 60}
+
+
+class LocallyCachedModel(models.Model):
+    value = models.IntegerField()
+
+get_entity_cache()[LocallyCachedModel] = {'timeout': 60, 'local_timeout': 60}
+
+
+class QueryCachedModel(models.Model):
+    value = models.IntegerField()
+
+get_query_cache()[QueryCachedModel] = {'timeout': 60}
+
+
+class CountedModel(models.Model):
+    value = models.IntegerField()
+
+get_sharded_counters()[CountedModel] = {'shards': 3}
@@ -2,6 +2,8 @@ from django.db import models
 from django.db.utils import DatabaseError
 from django.test import TestCase
 
+from .models import BlobModel
+
 
 class A(models.Model):
     value = models.IntegerField()
@@ -29,3 +31,14 @@ class BackendTest(TestCase):
         self.assertEqual(A.objects.all()[0].value, 3)
         self.assertRaises(DatabaseError, B.objects.count)
         self.assertRaises(DatabaseError, lambda: B.objects.all()[0])
+
+    def test_bulk_create(self):
+        # More entities and bytes than fit into a single Put.
+        A.objects.bulk_create([A(value=value) for value in range(501)])
+        self.assertEqual(
+            sorted(A.objects.values_list('value', flat=True)), range(501))
+        BlobModel.objects.bulk_create(
+            [BlobModel(data='%d' % index * 600000) for index in range(3)])
+        self.assertEqual(
+            sorted(blob.data[0] for blob in BlobModel.objects.all()),
+            ['0', '1', '2'])
@@ -0,0 +1,55 @@
+import datetime
+import os
+import time
+
+from django.db import connection
+from django.test import TestCase
+from django.utils import unittest
+
+from ..db.compiler import WritePlan, get_write_plan
+from .models import FieldsWithoutOptionsModel
+
+
+BENCHMARKS = os.environ.get('DJANGOAPPENGINE_BENCHMARKS')
+
+
+@unittest.skipUnless(BENCHMARKS, 'DJANGOAPPENGINE_BENCHMARKS not set')
+class WritePlanBenchmark(TestCase):
+    """
+    Compares the per-entity cost of building entities with a write
+    plan computed for each insert (as for single saves before plans
+    were cached) and with the cached plan.
+    """
+    entities = 2000
+
+    def get_data(self):
+        model = FieldsWithoutOptionsModel
+        obj = model(datetime=datetime.datetime.now(),
+                    date=datetime.date.today(), time=datetime.time(),
+                    floating_point=1.5, text='text',
+                    email='app-engine@scholardocs.com',
+                    comma_seperated_integer='1,2', ip_address='127.0.0.1',
+                    slug='slug', url='http://www.scholardocs.com',
+                    long_text='A' * 1000, indexed_text='text', integer=1,
+                    small_integer=1, positive_integer=1,
+                    positive_small_integer=1)
+        return dict((field.column, field.get_db_prep_save(
+                         field.pre_save(obj, True), connection=connection))
+                    for field in model._meta.local_fields
+                    if not field.primary_key)
+
+    def build_entities(self, get_plan):
+        data = self.get_data()
+        start = time.time()
+        for _ in xrange(self.entities):
+            plan = get_plan(FieldsWithoutOptionsModel, connection)
+            values = dict((column, plan.value_for_db(value, column))
+                          for column, value in data.iteritems())
+            plan.make_entity(values)
+        return (time.time() - start) / self.entities
+
+    def test_write_plan(self):
+        uncached = self.build_entities(WritePlan)
+        cached = self.build_entities(get_write_plan)
+        print '\nPer entity: %.1f us uncached, %.1f us cached' % (
+            uncached * 1e6, cached * 1e6)
@@ -0,0 +1,164 @@
+import threading
+
+from django.test import TestCase
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Entity, Get, Put, Key, \
+    RunInTransaction
+
+from ..db.caching import ENTITY_KEY_PREFIX, LOCKED, get_entities_async
+from ..db.utils import get_cursor, set_config, set_cursor
+from .models import CachedModel, QueryCachedModel
+
+
+class EntityCacheTest(TestCase):
+
+    def get_key(self, obj):
+        return Key.from_path(CachedModel._meta.db_table, obj.pk)
+
+    def test_pk_lookups_fill_cache(self):
+        obj = CachedModel.objects.create(value=1)
+        cache_key = ENTITY_KEY_PREFIX + str(self.get_key(obj))
+        self.assertIn(memcache.get(cache_key), (None, LOCKED))
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 1)
+        self.assertNotIn(memcache.get(cache_key), (None, LOCKED))
+
+    def test_cached_entities_are_used(self):
+        obj = CachedModel.objects.create(value=1)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 1)
+
+        # Changes bypassing the compilers don't invalidate the cache.
+        entity = Get(self.get_key(obj))
+        entity['value'] = 2
+        Put(entity)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 1)
+        self.assertEqual(
+            [item.value for item in
+                CachedModel.objects.filter(pk__in=[obj.pk])],
+            [1])
+
+    def test_writes_invalidate_cache(self):
+        obj = CachedModel.objects.create(value=1)
+        other = CachedModel.objects.create(value=2)
+        self.assertEqual(len(CachedModel.objects.filter(
+            pk__in=[obj.pk, other.pk])), 2)
+
+        CachedModel.objects.filter(pk=obj.pk).update(value=3)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 3)
+
+        CachedModel(pk=other.pk, value=4).save()
+        self.assertEqual(CachedModel.objects.get(pk=other.pk).value, 4)
+
+        CachedModel.objects.filter(pk=obj.pk).delete()
+        self.assertEqual(
+            [item.value for item in
+                CachedModel.objects.filter(pk__in=[obj.pk, other.pk])],
+            [4])
+
+    def test_write_during_get_is_not_overwritten(self):
+        obj = CachedModel.objects.create(value=1)
+        cache_key = ENTITY_KEY_PREFIX + str(self.get_key(obj))
+
+        # The Get misses the cache and reads the old entity, the update
+        # locks the cache entry before the Get's results are cached.
+        get_results = get_entities_async(CachedModel, [self.get_key(obj)])
+        CachedModel.objects.filter(pk=obj.pk).update(value=2)
+        self.assertEqual(get_results()[0]['value'], 1)
+        self.assertEqual(memcache.get(cache_key), LOCKED)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 2)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 2)
+
+    def test_transactional_write_during_get(self):
+        obj = CachedModel.objects.create(value=1)
+        key = self.get_key(obj)
+        results = []
+
+        def update():
+            CachedModel.objects.filter(pk=obj.pk).update(value=2)
+            # A lookup from another request before the commit still
+            # reads the old entity, but mustn't cache it.
+            thread = threading.Thread(target=lambda: results.append(
+                get_entities_async(CachedModel, [key])()))
+            thread.start()
+            thread.join()
+
+        RunInTransaction(update)
+        self.assertEqual(results[0][0]['value'], 1)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 2)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 2)
+
+
+class KeysThenGetTest(TestCase):
+
+    def test_keys_then_get(self):
+        for value in range(5):
+            CachedModel.objects.create(value=value)
+        queryset = set_config(
+            CachedModel.objects.filter(value__gte=1).order_by('-value'),
+            strategy='keys_then_get', batch_size=2)
+        self.assertEqual([item.value for item in queryset], [4, 3, 2, 1])
+        self.assertEqual([item.value for item in queryset[1:3]], [3, 2])
+        self.assertEqual(
+            sorted(item.value for item in
+                set_config(CachedModel.objects.filter(value__in=[1, 3]),
+                           strategy='keys_then_get')),
+            [1, 3])
+
+    def test_entities_come_from_cache(self):
+        obj = CachedModel.objects.create(value=1)
+        self.assertEqual(CachedModel.objects.get(pk=obj.pk).value, 1)
+
+        entity = Get(Key.from_path(CachedModel._meta.db_table, obj.pk))
+        entity['value'] = 2
+        Put(entity)
+        queryset = CachedModel.objects.filter(value__gte=1)
+        self.assertEqual(
+            [item.value for item in
+                set_config(queryset, strategy='keys_then_get')],
+            [1])
+        self.assertEqual([item.value for item in queryset], [2])
+
+
+class QueryCacheTest(TestCase):
+
+    def put_behind_compilers(self, value):
+        entity = Entity(QueryCachedModel._meta.db_table)
+        entity['value'] = value
+        Put(entity)
+
+    def test_results_are_cached_until_write(self):
+        QueryCachedModel.objects.create(value=1)
+        queryset = QueryCachedModel.objects.filter(value__gte=1) \
+            .order_by('value')
+        self.assertEqual([item.value for item in queryset], [1])
+
+        self.put_behind_compilers(2)
+        self.assertEqual([item.value for item in queryset.all()], [1])
+        self.assertEqual(
+            [item.value for item in set_config(queryset, query_cache=False)],
+            [1, 2])
+
+        QueryCachedModel.objects.create(value=3)
+        self.assertEqual([item.value for item in queryset.all()], [1, 2, 3])
+
+    def test_slices_are_cached_separately(self):
+        for value in range(4):
+            QueryCachedModel.objects.create(value=value)
+        queryset = QueryCachedModel.objects.order_by('value')
+        self.assertEqual([item.value for item in queryset[:2]], [0, 1])
+        self.assertEqual([item.value for item in queryset[2:]], [2, 3])
+        self.assertEqual(
+            list(queryset.values_list('value', flat=True)[1:3]), [1, 2])
+
+    def test_cached_cursor(self):
+        for value in range(3):
+            QueryCachedModel.objects.create(value=value)
+        for _ in range(2):
+            queryset = QueryCachedModel.objects.order_by('value')[:2]
+            self.assertEqual([item.value for item in queryset], [0, 1])
+            cursor = get_cursor(queryset)
+            self.assertEqual(
+                [item.value for item in
+                    set_cursor(QueryCachedModel.objects.order_by('value'),
+                               cursor)],
+                [2])
@@ -0,0 +1,76 @@
+from django.test import TestCase
+
+from google.appengine.api.datastore import Entity, Put
+
+from ..db.counters import get_counter_total, reset_counter
+from ..db.utils import set_config
+from .models import CountedModel, EmailModel
+
+
+class CountTest(TestCase):
+
+    def setUp(self):
+        for number in range(5):
+            EmailModel.objects.create(email='%d@example.com' % number,
+                                      number=number)
+
+    def test_count(self):
+        self.assertEqual(EmailModel.objects.count(), 5)
+        self.assertEqual(EmailModel.objects.all()[:3].count(), 3)
+        self.assertEqual(
+            EmailModel.objects.filter(number__in=[1, 3, 7]).count(), 2)
+        self.assertEqual(
+            set_config(EmailModel.objects.filter(number__gte=1),
+                       count_batch_size=2).count(),
+            4)
+
+    def test_count_with_excluded_pks(self):
+        pks = EmailModel.objects.filter(number__lt=2) \
+            .values_list('pk', flat=True)
+        queryset = EmailModel.objects.exclude(pk__in=list(pks))
+        self.assertEqual(queryset.count(), 3)
+        self.assertEqual(queryset[:2].count(), 2)
+
+    def test_count_cache(self):
+        queryset = set_config(EmailModel.objects.filter(number__gte=2),
+                              count_cache=60)
+        self.assertEqual(queryset.count(), 3)
+        EmailModel.objects.create(email='5@example.com', number=5)
+        self.assertEqual(queryset.count(), 3)
+        self.assertEqual(EmailModel.objects.filter(number__gte=2).count(), 4)
+
+
+class ShardedCounterTest(TestCase):
+
+    def test_writes_update_counter(self):
+        self.assertEqual(get_counter_total(CountedModel), 0)
+        for value in range(4):
+            CountedModel.objects.create(value=value)
+        self.assertEqual(get_counter_total(CountedModel), 4)
+        CountedModel.objects.filter(value__lt=2).delete()
+        self.assertEqual(get_counter_total(CountedModel), 2)
+        self.assertIsNone(get_counter_total(EmailModel))
+
+    def test_missing_and_existing_keys_are_not_counted(self):
+        obj = CountedModel.objects.create(value=1)
+        CountedModel.objects.bulk_create([CountedModel(pk=obj.pk, value=2),
+                                          CountedModel(value=3)])
+        self.assertEqual(get_counter_total(CountedModel), 2)
+        CountedModel.objects.filter(pk__in=[obj.pk, obj.pk + 1000]).delete()
+        self.assertEqual(get_counter_total(CountedModel), 1)
+        CountedModel.objects.filter(pk=obj.pk).delete()
+        self.assertEqual(get_counter_total(CountedModel), 1)
+
+    def test_count_uses_counter(self):
+        CountedModel.objects.create(value=1)
+
+        # Entities written bypassing the compilers aren't counted.
+        entity = Entity(CountedModel._meta.db_table)
+        entity['value'] = 2
+        Put(entity)
+        self.assertEqual(CountedModel.objects.count(), 1)
+        self.assertEqual(CountedModel.objects.filter(value__gte=1).count(), 2)
+
+        reset_counter(CountedModel)
+        self.assertEqual(CountedModel.objects.count(), 2)
+        self.assertEqual(CountedModel.objects.all()[:1].count(), 1)
@@ -1,5 +1,6 @@
 import datetime
 
+from django.db import connection
 from django.test import TestCase
 
 from google.appengine.api.datastore import Get
@@ -70,3 +71,25 @@ class FieldDBConversionTest(TestCase):
             if not isinstance(types, (list, tuple)):
                 types = (types, )
             self.assertTrue(type(getattr(model, name)) in types)
+
+    def test_converters(self):
+        ops = connection.ops
+        now = datetime.datetime.now()
+        for name, value in [('datetime', now), ('date', now.date()),
+                            ('time', now.time()), ('long_text', 'A' * 600),
+                            ('indexed_text', 'hello'), ('text', u'Hallo'),
+                            ('floating_point', 5.97), ('boolean', True),
+                            ('integer', -400), ('text', None)]:
+            field = FieldsWithoutOptionsModel._meta.get_field(name)
+            convert = ops.get_converter(field, 'for_db')
+            self.assertIs(ops.get_converter(field, 'for_db'), convert)
+
+            # Specialized converters agree with the generic conversions.
+            db_value = convert(value)
+            self.assertEqual(db_value, ops._value_for_db(
+                value, *ops._convert_as(field) + (None,)))
+            self.assertEqual(type(db_value), type(ops._value_for_db(
+                value, *ops._convert_as(field) + (None,))))
+            self.assertEqual(
+                ops.get_converter(field, 'from_db')(db_value),
+                ops._value_from_db(db_value, *ops._convert_as(field)))
@@ -1,5 +1,8 @@
+from __future__ import with_statement
+
 import datetime
 import time
+import warnings
 
 from django.db import models
 from django.db.models import Q
@@ -9,9 +12,11 @@ from django.utils import unittest
 
 from google.appengine.api.datastore import Get, Key
 
-from ..db.utils import get_cursor, set_cursor
+from ..db.recording import RPCRecorder
+from ..db.utils import get_cursor, set_config, set_cursor, prefetch_async, \
+    prefetch_foreign_keys, stream, explain
 from .models import FieldsWithOptionsModel, EmailModel, DateTimeModel, \
-    OrderedModel, BlobModel
+    OrderedModel, OrderedPairModel, BlobModel
 
 
 class FilterTest(TestCase):
@@ -217,6 +222,41 @@ class FilterTest(TestCase):
                 .exclude(pk__in=[2, 3]).order_by('pk')],
             [1, 4])
 
+        # Key range sub-queries.
+        queryset = set_config(OrderedModel.objects.exclude(pk__in=[3, 1])
+            .order_by('-pk'), split_excluded_pks=True)
+        self.assertEquals([entity.pk for entity in queryset], [4, 2])
+        self.assertEquals([entity.pk for entity in queryset[1:]], [2])
+        self.assertEquals([entity.pk for entity in queryset[:1]], [4])
+        self.assertEquals(queryset.count(), 2)
+        self.assertEquals(
+            [entity.pk for entity in queryset.filter(priority=1)], [2])
+
+        # Ranges are only queried until the slice is filled.
+        queryset = set_config(OrderedModel.objects.exclude(pk=4)
+            .order_by('pk'), split_excluded_pks=True)[:2]
+        with RPCRecorder() as recorder:
+            self.assertEquals([entity.pk for entity in queryset], [1, 2])
+        self.assertEquals(recorder.get_counts(), {'RunQuery': 1})
+        self.assertEquals(recorder.entities_read, 2)
+        self.assertEquals(explain(queryset)['overfetch'], 1.0)
+
+        # Excluded entities dropped while fetching.
+        self.assertEquals(
+            [entity.pk for entity in OrderedModel.objects
+                .exclude(pk__in=[1, 4]).filter(priority__gte=1)
+                .order_by('priority')],
+            [2, 3])
+
+    def test_exclude_pk_cursor(self):
+        queryset = OrderedModel.objects.exclude(pk=2).order_by('pk')
+        page = queryset[:2]
+        self.assertEquals([entity.pk for entity in page], [1, 3])
+        cursor = get_cursor(page)
+        self.assertNotEqual(cursor, None)
+        self.assertEquals(
+            [entity.pk for entity in set_cursor(queryset, cursor)], [4])
+
     def test_chained_filter(self):
         # Additionally tests count :)
         self.assertEquals(FieldsWithOptionsModel.objects.filter(
@@ -319,6 +359,149 @@ class FilterTest(TestCase):
         query = set_cursor(FieldsWithOptionsModel.objects.all(), cursor)
         self.assertEqual(list(query[:1]), [])
 
+    def test_prefetch_async(self):
+        emails = prefetch_async(EmailModel.objects.order_by('email'))
+        integers = prefetch_async(FieldsWithOptionsModel.objects
+            .filter(integer__gt=3).order_by('integer').values_list('integer',
+                                                                   flat=True))
+        pks = prefetch_async(FieldsWithOptionsModel.objects
+            .filter(pk__in=['rasengan@naruto.com', 'sharingan@uchias.com'])
+            .order_by('email'))
+        self.assertEquals([entity.email for entity in emails],
+                          sorted(self.emails))
+        self.assertEquals(list(integers), [5, 9])
+        self.assertEquals([entity.email for entity in pks],
+                          ['rasengan@naruto.com', 'sharingan@uchias.com'])
+
+        # Slices are fetched as given.
+        self.assertEquals(
+            [entity.email for entity in prefetch_async(
+                EmailModel.objects.order_by('email')[1:3])],
+            sorted(self.emails)[1:3])
+
+    def test_prefetch_async_clone(self):
+        with RPCRecorder() as recorder:
+            emails = prefetch_async(EmailModel.objects.order_by('email'))
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                copy = emails.all()
+            self.assertEquals([entity.email for entity in copy],
+                              sorted(self.emails))
+        # The copy ran the query again.
+        self.assertEquals(recorder.get_counts(), {'RunQuery': 2})
+        self.assertEquals([warning.category for warning in caught],
+                          [RuntimeWarning])
+
+        with RPCRecorder() as recorder:
+            self.assertEquals(len(emails), len(self.emails))
+        self.assertEquals(recorder.calls, [])
+
+    def test_prefetch_foreign_keys(self):
+        entities = prefetch_foreign_keys(
+            FieldsWithOptionsModel.objects.order_by('email'))
+        with RPCRecorder() as recorder:
+            priorities = [entity.foreign_key.priority for entity in entities]
+        self.assertEquals(recorder.calls, [])
+        self.assertEquals(priorities, [0, 3, 2, 1])
+
+        # Instances without a related object or with a cached one are
+        # left alone.
+        entities = list(FieldsWithOptionsModel.objects.order_by('email'))
+        entities[0].foreign_key = None
+        cached = entities[1].foreign_key
+        with RPCRecorder() as recorder:
+            prefetch_foreign_keys(entities, 'foreign_key')
+        self.assertEquals(recorder.get_counts(), {'Get': 1})
+        self.assertEquals(entities[0].foreign_key, None)
+        self.assertTrue(entities[1].foreign_key is cached)
+        self.assertEquals([entity.foreign_key.priority
+                           for entity in entities[2:]], [2, 1])
+
+        # Fields referring to the same model share a single Get.
+        OrderedPairModel.objects.create(first_id=1, second_id=2)
+        OrderedPairModel.objects.create(first_id=2, second_id=3)
+        pairs = list(OrderedPairModel.objects.order_by('first'))
+        with RPCRecorder() as recorder:
+            prefetch_foreign_keys(pairs)
+        self.assertEquals(recorder.get_counts(), {'Get': 1})
+        self.assertEquals(recorder.entities_read, 3)
+        with RPCRecorder() as recorder:
+            self.assertEquals([(pair.first.priority, pair.second.priority)
+                               for pair in pairs], [(0, 1), (1, 2)])
+        self.assertEquals(recorder.calls, [])
+
+    def test_stream(self):
+        self.assertEquals(
+            [entity.email for entity in
+                stream(FieldsWithOptionsModel.objects.order_by('email'),
+                       batch_size=3)],
+            sorted(self.emails))
+        self.assertEquals(
+            list(stream(FieldsWithOptionsModel.objects
+                .filter(integer__gt=1).order_by('integer')
+                .values_list('integer', flat=True), batch_size=1)),
+            [2, 5, 9])
+        self.assertRaises(ValueError, lambda: list(
+            stream(FieldsWithOptionsModel.objects.all()[:2])))
+        # Queries without cursors fail before any results are returned.
+        self.assertRaises(DatabaseError, stream,
+            FieldsWithOptionsModel.objects.filter(
+                integer__in=[1, 2]).order_by('integer'))
+        self.assertEquals(
+            [entity.email for entity in
+                stream(FieldsWithOptionsModel.objects
+                       .exclude(pk=self.emails[0]).order_by('email'),
+                       batch_size=2)],
+            sorted(self.emails[1:]))
+
+    def test_delete_in_batches(self):
+        set_config(FieldsWithOptionsModel.objects.filter(integer__gte=2),
+                   delete_batch_size=1).delete()
+        self.assertEquals(
+            [entity.email for entity in FieldsWithOptionsModel.objects.all()],
+            ['rasengan@naruto.com'])
+        kept = EmailModel.objects.get(email='sharingan@uchias.com')
+        set_config(EmailModel.objects.exclude(pk=kept.pk),
+                   delete_batch_size=2).delete()
+        self.assertEquals(
+            [entity.email for entity in EmailModel.objects.all()],
+            ['sharingan@uchias.com'])
+
+    def test_explain(self):
+        plan = explain(FieldsWithOptionsModel.objects
+            .filter(pk__in=self.emails[:2], integer=5).order_by('integer'))
+        self.assertEquals(plan['strategy'], 'get')
+        self.assertEquals(plan['in_memory'], ['filter', 'sort'])
+        self.assertEquals(plan['rpcs'], 1)
+
+        # Sliced primary key lookups are fetched in chunks of the slice
+        # end until enough entities match the filters.
+        plan = explain(FieldsWithOptionsModel.objects
+            .filter(pk__in=self.emails, integer=5).order_by('pk')[:2])
+        self.assertEquals(plan['in_memory'], ['filter'])
+        self.assertEquals(plan['rpcs'], (len(self.emails) + 1) // 2)
+        plan = explain(FieldsWithOptionsModel.objects
+            .filter(pk__in=self.emails).order_by('pk')[:2])
+        self.assertEquals(plan['rpcs'], 1)
+
+        queryset = FieldsWithOptionsModel.objects \
+            .filter(integer__in=[1, 2, 5]).order_by('-floating_point')[:2]
+        plan = explain(queryset, execute=True)
+        self.assertEquals(plan['strategy'], 'query')
+        self.assertEquals(len(plan['sub_queries']), 3)
+        self.assertEquals(plan['in_memory'], ['merge'])
+        self.assertEquals(plan['indexes'], [
+            (FieldsWithOptionsModel._meta.db_table,
+             (('integer', 'asc'), ('floating_point', 'desc')))])
+        self.assertEquals(plan['rpcs'], 3)
+        self.assertEquals(plan['overfetch'], 3.0)
+        self.assertEquals(plan['executed']['results'], 2)
+        self.assertEquals(plan['executed']['rpcs']['RunQuery'], 3)
+
+        plan = explain(FieldsWithOptionsModel.objects.filter(integer=5))
+        self.assertEquals(plan['indexes'], [])
+        self.assertEquals(plan['rpcs'], None)
+
     def test_Q_objects(self):
         self.assertEquals(
             [entity.email for entity in FieldsWithOptionsModel.objects
@@ -345,6 +528,39 @@ class FilterTest(TestCase):
                                    'rasengan@naruto.com'])],
             ['app-engine@scholardocs.com', 'rasengan@naruto.com'])
 
+    def test_pk_in_with_ordering(self):
+        queryset = FieldsWithOptionsModel.objects.filter(pk__in=self.emails)
+        self.assertEquals(
+            [entity.email for entity in
+                queryset.filter(integer__lte=5).order_by('-integer')],
+            ['app-engine@scholardocs.com', 'sharingan@uchias.com',
+             'rasengan@naruto.com'])
+        self.assertEquals(
+            [entity.email for entity in
+                queryset.filter(Q(integer=1) | Q(floating_point__gt=9))
+                .order_by('text', '-email')],
+            ['rinnengan@sage.de', 'rasengan@naruto.com'])
+        self.assertEquals(
+            [entity.email for entity in queryset.order_by('-pk')[1:3]],
+            ['rinnengan@sage.de', 'rasengan@naruto.com'])
+
+    def test_pk_in_with_slicing(self):
+        queryset = FieldsWithOptionsModel.objects.filter(
+            pk__in=['missing@example.com'] + self.emails)
+        self.assertEquals(
+            [entity.email for entity in queryset[:2]],
+            ['app-engine@scholardocs.com', 'sharingan@uchias.com'])
+        self.assertEquals(
+            [entity.email for entity in queryset.filter(integer__gte=5)[1:2]],
+            ['rinnengan@sage.de'])
+        self.assertEquals(
+            [entity.email for entity in queryset.order_by('pk')[:2]],
+            ['app-engine@scholardocs.com', 'rasengan@naruto.com'])
+        self.assertEquals(
+            [entity.email for entity in
+                queryset.filter(integer__lt=9).order_by('-pk')[1:]],
+            ['rasengan@naruto.com', 'app-engine@scholardocs.com'])
+
     def test_in(self):
         self.assertEquals(
             [entity.email for entity in FieldsWithOptionsModel.objects
@@ -378,6 +594,19 @@ class FilterTest(TestCase):
         orders = [post.order for post in posts]
         self.assertEqual(orders, range(5, 0, -1))
 
+    def test_in_with_slicing(self):
+        self.assertEquals(
+            [entity.integer for entity in FieldsWithOptionsModel.objects
+                .filter(integer__in=[1, 2, 5, 9]).order_by('-integer')[1:3]],
+            [5, 2])
+        self.assertEquals(
+            list(FieldsWithOptionsModel.objects
+                .filter(integer__in=[1, 9]).order_by('integer')
+                .values_list('pk', flat=True)),
+            ['rasengan@naruto.com', 'rinnengan@sage.de'])
+        self.assertEquals(FieldsWithOptionsModel.objects
+            .filter(integer__in=[1, 2, 5]).count(), 3)
+
     def test_inequality(self):
         self.assertEquals(
             [entity.email for entity in FieldsWithOptionsModel.objects
@@ -415,6 +644,55 @@ class FilterTest(TestCase):
                 .filter(integer__gt=3).order_by('integer').values_list('pk')],
             ['app-engine@scholardocs.com', 'rinnengan@sage.de'])
 
+    def get_projection(self, queryset):
+        compiler = queryset.query.get_compiler(queryset.db)
+        return compiler.build_query(compiler.get_fields()).get_projection()
+
+    def test_projection(self):
+        queryset = set_config(FieldsWithOptionsModel.objects
+            .filter(integer__gt=3).order_by('integer'), projection=True)
+        values = queryset.values_list('floating_point', 'integer')
+        self.assertEquals(self.get_projection(values),
+                          ['floating_point', 'integer'])
+        self.assertEquals(list(values), [(5.3, 5), (9.1, 9)])
+        self.assertEquals([entity.integer
+                           for entity in queryset.only('integer')],
+                          [5, 9])
+        self.assertEquals(list(queryset.values_list('datetime', flat=True)),
+                          [entity.datetime for entity in queryset])
+        self.assertEquals(list(queryset.values_list('foreign_key',
+                                                    flat=True)),
+                          [entity.foreign_key_id for entity in queryset])
+
+        # Whole entities are needed for properties with equality
+        # filters and for unindexed properties.
+        self.assertIsNone(self.get_projection(
+            set_config(FieldsWithOptionsModel.objects.filter(integer=5),
+                       projection=True).values_list('integer')))
+        self.assertIsNone(self.get_projection(
+            queryset.values_list('long_text')))
+        self.assertEquals(
+            list(set_config(FieldsWithOptionsModel.objects.filter(integer=5),
+                            projection=True)
+                .values_list('integer', flat=True)),
+            [5])
+        self.assertEquals(
+            list(queryset.values_list('long_text', flat=True)),
+            [1000 * 'A', 1000 * 'A'])
+
+    def test_projection_is_opt_in(self):
+        # Without the option multi-property (and any other) values
+        # querysets fetch whole entities, needing no composite index.
+        queryset = FieldsWithOptionsModel.objects.filter(integer__gt=3) \
+            .order_by('integer')
+        values = queryset.values_list('floating_point', 'integer')
+        self.assertIsNone(self.get_projection(values))
+        self.assertEquals(explain(values)['projection'], None)
+        self.assertEquals(explain(values)['indexes'], [])
+        self.assertEquals(list(values), [(5.3, 5), (9.1, 9)])
+        self.assertIsNone(self.get_projection(
+            set_config(queryset, projection=False).values_list('integer')))
+
     def test_range(self):
         # Test range on float.
         self.assertEquals(
@@ -0,0 +1,64 @@
+from django.test import TestCase
+
+from google.appengine.api.datastore import Query
+
+from ..db.indexes import format_index, get_required_index
+from ..db.signals import query_built
+from .models import OrderedModel
+
+
+ASC = Query.ASCENDING
+DESC = Query.DESCENDING
+
+
+class IndexesTest(TestCase):
+
+    def test_built_in_indexes(self):
+        for filters, ordering in [
+                ((), ()),
+                (('a =', 'b ='), ()),
+                (('a =', '__key__ >'), (('__key__', ASC),)),
+                (('a >', 'a <'), (('a', DESC),)),
+                (('a =',), (('a', ASC),)),
+                ((), (('a', DESC),))]:
+            self.assertEqual(
+                get_required_index('Kind', filters, ordering), None)
+
+    def test_composite_indexes(self):
+        self.assertEqual(
+            get_required_index('Kind', ('b =', 'a =', 'c >'),
+                               (('c', DESC), ('d', ASC))),
+            ('Kind', (('a', 'asc'), ('b', 'asc'), ('c', 'desc'),
+                      ('d', 'asc'))))
+        self.assertEqual(
+            get_required_index('Kind', ('a =', 'b <='), ()),
+            ('Kind', (('a', 'asc'), ('b', 'asc'))))
+        self.assertEqual(
+            get_required_index('Kind', (), (('__key__', DESC),)),
+            ('Kind', (('__key__', 'desc'),)))
+        self.assertEqual(
+            get_required_index('Kind', ('a =',), (), ['b']),
+            ('Kind', (('a', 'asc'), ('b', 'asc'))))
+        self.assertEqual(
+            format_index(('Kind', (('a', 'asc'), ('b', 'desc')))),
+            '- kind: Kind\n'
+            '  properties:\n'
+            '  - name: a\n'
+            '  - name: b\n'
+            '    direction: desc')
+
+    def test_query_built_signal(self):
+        indexes = []
+
+        def record(sender, query, **kwargs):
+            indexes.extend(query.get_required_indexes())
+
+        query_built.connect(record)
+        try:
+            list(OrderedModel.objects.filter(priority__gt=1)
+                                     .order_by('priority', '-id'))
+        finally:
+            query_built.disconnect(record)
+        self.assertEqual(indexes, [
+            (OrderedModel._meta.db_table,
+             (('priority', 'asc'), ('__key__', 'desc')))])
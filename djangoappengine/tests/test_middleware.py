@@ -0,0 +1,126 @@
+from __future__ import with_statement
+
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..db.querystats import format_stats, get_stats, record_query, \
+    reset_stats
+from ..db.signals import query_executed
+from ..middleware import DatastoreStatsMiddleware, RPCBudgetExceeded, \
+    rpc_budget
+from .models import EmailModel
+
+
+def list_emails(request):
+    emails = [obj.email for obj in EmailModel.objects.all()]
+    return HttpResponse(', '.join(emails))
+
+
+@rpc_budget(rpcs=1)
+def save_emails(request):
+    for email in ('app-engine@scholardocs.com', 'sharingan@uchias.com'):
+        EmailModel(email=email).save()
+    return HttpResponse()
+
+
+class DatastoreStatsMiddlewareTest(TestCase):
+
+    def get_response(self, view):
+        with override_settings(DATASTORE_STATS_HEADERS=True):
+            middleware = DatastoreStatsMiddleware()
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = '/'
+        middleware.process_request(request)
+        middleware.process_view(request, view, (), {})
+        return middleware.process_response(request, view(request))
+
+    def test_headers(self):
+        EmailModel(email='app-engine@scholardocs.com').save()
+        response = self.get_response(list_emails)
+        self.assertEqual(response['X-Datastore-RPCs'], 'RunQuery=1')
+        self.assertEqual(response['X-Datastore-Entities'],
+                         'read=1, written=0')
+        self.assertTrue(response['X-Datastore-Time'].endswith('ms'))
+        self.assertTrue(response['X-Request-Time'].endswith('ms'))
+
+    def test_exception_stops_recording(self):
+        middleware = DatastoreStatsMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        recorder = request._datastore_recorder
+        middleware.process_exception(request, ValueError())
+        list(EmailModel.objects.all())
+        self.assertEqual(recorder.calls, [])
+
+        # Recorders of requests without processed responses are stopped
+        # by the next request, too.
+        middleware.process_request(request)
+        recorder = request._datastore_recorder
+        middleware.process_request(HttpRequest())
+        middleware.process_exception(request, ValueError())
+        list(EmailModel.objects.all())
+        self.assertEqual(recorder.calls, [])
+
+    def test_budget(self):
+        # Outside of DEBUG exceeding the budget only logs a warning.
+        response = self.get_response(save_emails)
+        self.assertEqual(response['X-Datastore-RPCs'], 'Put=2')
+        self.assertEqual(response['X-Datastore-Entities'],
+                         'read=0, written=2')
+        with override_settings(DEBUG=True):
+            self.assertRaises(RPCBudgetExceeded,
+                              self.get_response, save_emails)
+
+    def test_query_executed(self):
+        for i in range(3):
+            EmailModel(email='%d@scholardocs.com' % i, number=i).save()
+        executed = []
+
+        def record(sender, method, recorder, results, **kwargs):
+            executed.append((method, recorder.get_counts(), results))
+
+        query_executed.connect(record)
+        try:
+            list(EmailModel.objects.filter(number__gte=1))
+            EmailModel.objects.filter(number__gte=1).count()
+            EmailModel.objects.filter(number=2).delete()
+        finally:
+            query_executed.disconnect(record)
+        self.assertEqual(executed[:2], [
+            ('fetch', {'RunQuery': 1}, 2),
+            ('count', {'RunQuery': 1}, 2)])
+        self.assertEqual(executed[-1][0], 'delete')
+
+
+class QueryStatsTest(TestCase):
+
+    def setUp(self):
+        reset_stats()
+        query_executed.connect(record_query)
+
+    def tearDown(self):
+        query_executed.disconnect(record_query)
+        reset_stats()
+
+    def test_fingerprints(self):
+        for i in range(3):
+            EmailModel(email='%d@scholardocs.com' % i, number=i).save()
+        list(EmailModel.objects.filter(number__gte=1).order_by('-number'))
+        list(EmailModel.objects.filter(number__gte=2).order_by('-number'))
+        list(EmailModel.objects.filter(number__in=[1, 2]))
+        EmailModel.objects.count()
+
+        table = EmailModel._meta.db_table
+        stats = get_stats()
+        self.assertEqual(sorted(stats.keys()), [
+            ('count', '%s WHERE *' % table),
+            ('fetch', '%s WHERE number = MULTI' % table),
+            ('fetch', '%s WHERE number >= ORDER BY -number' % table)])
+        item = stats[('fetch', '%s WHERE number >= ORDER BY -number' %
+                      table)]
+        self.assertEqual(item.count, 2)
+        self.assertEqual(item.results, 3)
+        self.assertEqual(sum(item.histogram), 2)
+        self.assertTrue('2 queries' in format_stats(stats))
@@ -0,0 +1,88 @@
+from __future__ import with_statement
+
+from cStringIO import StringIO
+import os
+import sys
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..test import ParallelTestSuiteRunner, split_suite
+
+
+class ParallelTestRunnerTest(TestCase):
+
+    def test_split_suite(self):
+        from django.utils.unittest import TestLoader, TestSuite
+
+        loader = TestLoader()
+        suite = TestSuite([
+            loader.loadTestsFromTestCase(ParallelTestRunnerTest),
+            loader.loadTestsFromTestCase(EmptyTest)])
+        suites = split_suite(suite, 3)
+        # Tests of a class stay together.
+        self.assertEqual(len(suites), 2)
+        self.assertEqual([set(test.__class__ for test in worker_suite)
+                          for worker_suite in suites],
+                         [set([ParallelTestRunnerTest]), set([EmptyTest])])
+        self.assertEqual(sum(worker_suite.countTestCases()
+                             for worker_suite in suites),
+                         suite.countTestCases())
+
+    def test_parallel_test_runner(self):
+        from django.utils import unittest
+
+        class Failing(unittest.TestCase):
+
+            def test_pass(self):
+                pass
+
+            def test_fail(self):
+                self.fail()
+
+        class Erroring(unittest.TestCase):
+
+            def test_error(self):
+                raise ValueError
+
+        class Crashing(unittest.TestCase):
+
+            def test_crash(self):
+                os._exit(1)
+
+        def run(*test_cases):
+            loader = unittest.TestLoader()
+            suite = unittest.TestSuite([loader.loadTestsFromTestCase(test_case)
+                                        for test_case in test_cases])
+            runner = ParallelTestSuiteRunner(verbosity=0)
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                with override_settings(TEST_WORKERS=2):
+                    result = runner.run_suite(suite)
+            finally:
+                sys.stderr = stderr
+            return result, runner.suite_result(suite, result)
+
+        result, status = run(Failing, Erroring)
+        self.assertEqual(result.testsRun, 3)
+        self.assertEqual([test for test, trace in result.failures],
+                         [str(Failing('test_fail'))])
+        self.assertEqual([test for test, trace in result.errors],
+                         [str(Erroring('test_error'))])
+        self.assertFalse(result.wasSuccessful())
+        self.assertEqual(status, 2)
+
+        # A crashed worker's tests are reported as a single error.
+        result, status = run(Failing, Crashing)
+        self.assertEqual(result.testsRun, 2)
+        self.assertEqual(len(result.failures), 1)
+        self.assertEqual([trace for test, trace in result.errors],
+                         ["The worker process died."])
+        self.assertEqual(status, 2)
+
+
+class EmptyTest(TestCase):
+
+    def test_nothing(self):
+        pass
@@ -13,6 +13,12 @@ from djangoappengine.storage import AppEngineStorage, CloudStorageInfo, BLOBSTOR
 from google.appengine.api import files
 from google.appengine.ext.blobstore import BlobInfo, BlobKey
 
+from ..db.stubs import stub_manager
+
+
+stub_manager.require_test_stubs('app_identity', 'blobstore', 'files',
+                                'urlfetch')
+
 
 class AppEngineStorageBaseTest(object):
     def test_file_accessed_time(self):
@@ -0,0 +1,87 @@
+import os
+
+from django.db import connection
+from django.test import TestCase
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Entity, Put, Query
+
+from ..db.base import delete_all_entities
+from ..db.stubs import stub_manager
+from .models import BlobModel, EmailModel, LocallyCachedModel
+
+
+class FlushTest(TestCase):
+
+    def test_delete_all_entities(self):
+        EmailModel.objects.bulk_create(
+            [EmailModel(number=number) for number in range(5)])
+        BlobModel(data='data').save()
+        Put([Entity('Other', namespace='other') for _ in range(3)])
+        progress = []
+        delete_all_entities(batch_size=2, progress=lambda *args:
+                            progress.append(args))
+        self.assertEqual(EmailModel.objects.count(), 0)
+        self.assertEqual(BlobModel.objects.count(), 0)
+        self.assertEqual(Query('Other', namespace='other').Count(), 0)
+        self.assertTrue(('other', 'Other', 3) in progress)
+        self.assertTrue(('', EmailModel._meta.db_table, 5) in progress)
+
+    def test_flush(self):
+        EmailModel(number=1).save()
+        memcache.set('key', 'value')
+        stub = stub_manager.testbed.get_stub('datastore_v3')
+        connection.flush()
+        # The test stubs are emptied instead of being set up again.
+        self.assertTrue(stub_manager.testbed.get_stub('datastore_v3') is stub)
+        self.assertEqual(EmailModel.objects.count(), 0)
+        self.assertEqual(memcache.get('key'), None)
+
+    def test_flush_clears_local_cache(self):
+        obj = LocallyCachedModel.objects.create(value=1)
+        self.assertEqual(LocallyCachedModel.objects.get(pk=obj.pk).value, 1)
+        connection.flush()
+
+        # Written bypassing the compilers, so only the flush can have
+        # dropped the entity cached in process memory.
+        entity = Entity(LocallyCachedModel._meta.db_table, id=obj.pk)
+        entity['value'] = 2
+        Put(entity)
+        self.assertEqual(LocallyCachedModel.objects.get(pk=obj.pk).value, 2)
+
+    def test_flush_resets_other_stubs(self):
+        stub_manager.require_test_stubs('blobstore', 'files')
+        blobstore_stub = stub_manager.testbed.get_stub('blobstore')
+        files_stub = stub_manager.testbed.get_stub('file')
+        os.environ['USER_EMAIL'] = 'test@example.com'
+        os.environ['USER_IS_ADMIN'] = '1'
+        os.environ['OTHER'] = 'value'
+
+        connection.flush()
+        # Stubs keeping state without a faster way to empty them are
+        # replaced, and the environment changes are undone.
+        self.assertFalse(
+            stub_manager.testbed.get_stub('blobstore') is blobstore_stub)
+        self.assertFalse(stub_manager.testbed.get_stub('file') is files_stub)
+        self.assertEqual(dict(os.environ), stub_manager.test_environ)
+
+
+class DatastoreSnapshotTest(TestCase):
+
+    def test_datastore_snapshot(self):
+        EmailModel.objects.bulk_create(
+            [EmailModel(number=number) for number in range(3)])
+        Put(Entity('Other', namespace='other'))
+        snapshot = stub_manager.take_datastore_snapshot()
+        EmailModel.objects.filter(number=0).delete()
+        EmailModel.objects.filter(number=1).update(number=5)
+        EmailModel(number=6).save()
+
+        stub_manager.restore_datastore_snapshot(snapshot)
+        self.assertEqual(
+            sorted(EmailModel.objects.values_list('number', flat=True)),
+            [0, 1, 2])
+        self.assertEqual(Query('Other', namespace='other').Count(), 1)
+        # Restored IDs aren't assigned to new entities.
+        pks = set(EmailModel.objects.values_list('pk', flat=True))
+        self.assertFalse(EmailModel.objects.create(number=7).pk in pks)
@@ -1,6 +1,10 @@
+from __future__ import with_statement
+
 from django.db.models import F
 from django.test import TestCase
 
+from ..db.recording import RPCRecorder
+from ..db.utils import set_config
 from .models import EmailModel
 
 
@@ -28,6 +32,41 @@ class TransactionTest(TestCase):
         self.assertEqual(3, len(EmailModel.objects.all().filter(
             email=self.emails[1])))
 
+    def test_batched_update(self):
+        queryset = set_config(EmailModel.objects.all(), update_batch_size=2)
+        self.assertEqual(queryset.filter(email=self.emails[0]).update(
+            email=self.emails[2], number=7), 2)
+        self.assertEqual(queryset.update(number=8), 3)
+
+        self.assertEqual(2, len(EmailModel.objects.all().filter(
+            email=self.emails[2], number=8)))
+        self.assertEqual(1, len(EmailModel.objects.all().filter(
+            email=self.emails[1], number=8)))
+
+    def test_filtered_update_is_transactional(self):
+        pks = list(EmailModel.objects.values_list('pk', flat=True))
+        with RPCRecorder() as recorder:
+            EmailModel.objects.filter(pk__in=pks).update(number=5)
+        self.assertFalse('Commit' in recorder.get_counts())
+
+        # Entities can stop matching between the query and their Put,
+        # so each is re-checked and written in its own transaction.
+        with RPCRecorder() as recorder:
+            self.assertEqual(EmailModel.objects.filter(
+                email=self.emails[0]).update(number=6), 2)
+        self.assertEqual(recorder.get_counts()['Commit'], 2)
+        self.assertEqual(sorted(EmailModel.objects.values_list(
+            'number', flat=True)), [5, 6, 6])
+
+    def test_non_transactional_f_object_update(self):
+        queryset = set_config(EmailModel.objects.all(),
+                              transactional_update=False)
+        queryset.filter(email=self.emails[0]).update(
+            number=F('number') + 10)
+
+        self.assertEqual(sorted(EmailModel.objects.all().values_list(
+            'number', flat=True)), [3, 11, 12])
+
     def test_f_object_updates(self):
         self.assertEqual(1, len(EmailModel.objects.all().filter(
             number=1)))
@@ -1,5 +1,5 @@
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden
 from django.utils.importlib import import_module
 
 
@@ -16,3 +16,23 @@ def warmup(request):
                 pass
     content_type = 'text/plain; charset=%s' % settings.DEFAULT_CHARSET
     return HttpResponse("Warmup done.", content_type=content_type)
+
+
+def query_stats(request):
+    """
+    Shows the query stats collected with DATASTORE_QUERY_STATS, most
+    expensive query shapes first, to App Engine administrators. POST
+    resets the stats.
+    """
+    from google.appengine.api import users
+    from .db.querystats import format_stats, get_stats, reset_stats
+
+    if not users.is_current_user_admin():
+        return HttpResponseForbidden()
+    if request.method == 'POST':
+        reset_stats()
+        content = "Query stats reset."
+    else:
+        content = format_stats(get_stats()) or "No query stats collected."
+    content_type = 'text/plain; charset=%s' % settings.DEFAULT_CHARSET
+    return HttpResponse(content, content_type=content_type)